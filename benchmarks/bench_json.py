@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""比较json_loads/json_dumps在标准库json和orjson下的速度
+
+使用corpus中按m.weibo.cn接口返回格式整理的样例数据（内容已替换为随机文本）：
+getindex_page.json  getIndex接口返回的一页微博
+detail_page.html    长微博详情页，按get_long_weibo的方式截取其中的json
+
+用法：python benchmarks/bench_json.py [-n 次数]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+BENCH_DIR = os.path.split(os.path.realpath(__file__))[0]
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import weibo  # noqa: E402
+
+
+def read_corpus(name):
+    with open(os.path.join(BENCH_DIR, 'corpus', name), 'rb') as f:
+        return f.read()
+
+
+def slice_detail(html):
+    """和get_long_weibo一样从详情页中截取status的json"""
+    html = html[html.find('"status":'):]
+    html = html[:html.rfind('"hotScheme"')]
+    html = html[:html.rfind(',')]
+    return '{' + html + '}'
+
+
+def get_cases(archive_size):
+    page = read_corpus('getindex_page.json')
+    detail = slice_detail(read_corpus('detail_page.html').decode('utf-8'))
+    mblogs = [
+        card['mblog'] for card in weibo.json_loads(page)['data']['cards']
+        if card['card_type'] == 9
+    ]
+    archive = {'weibo': (mblogs * (archive_size // len(mblogs) + 1))[:archive_size]}
+    lines = [weibo.json_dumps(m) for m in archive['weibo']]
+    return [
+        ('loads getIndex page', lambda: weibo.json_loads(page)),
+        ('loads detail page', lambda: weibo.json_loads(detail)),
+        ('dumps json archive', lambda: weibo.json_dumps(archive)),
+        ('dumps jsonl lines', lambda: [weibo.json_dumps(m) for m in archive['weibo']]),
+        ('loads jsonl lines', lambda: [weibo.json_loads(line) for line in lines]),
+    ]
+
+
+def run(number, archive_size):
+    backends = [('json', None)]
+    if weibo.orjson is not None:
+        backends.append(('orjson', weibo.orjson))
+    else:
+        print(u'没有安装orjson，只测试标准库json')
+    installed = weibo.orjson
+    results = {}
+    try:
+        for backend, module in backends:
+            weibo.orjson = module
+            for name, func in get_cases(archive_size):
+                best = min(timeit.repeat(func, number=number, repeat=5))
+                results.setdefault(name, {})[backend] = best / number
+    finally:
+        weibo.orjson = installed
+    header = '%-22s' % 'case' + ''.join('%14s' % b for b, _ in backends)
+    if len(backends) > 1:
+        header += '%10s' % 'speedup'
+    print(header)
+    for name, times in results.items():
+        row = '%-22s' % name + ''.join('%12.1fus' % (times[b] * 1e6)
+                                      for b, _ in backends)
+        if len(backends) > 1:
+            row += '%9.1fx' % (times['json'] / times['orjson'])
+        print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=20,
+                        help=u'每轮运行的次数')
+    parser.add_argument('--archive-size', type=int, default=2000,
+                        help=u'json/jsonl结果文件中的微博条数')
+    args = parser.parse_args()
+    run(args.number, args.archive_size)
+
+
+if __name__ == '__main__':
+    main()
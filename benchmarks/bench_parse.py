@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""解析和生成嘟文这些热点代码的基准测试
+
+使用corpus中的样例数据（getindex_page.json里的微博和detail_page.html里的长微博），
+测量每次调用的耗时和分配的内存，并与baseline.json中保存的基准结果比较。
+耗时和机器有关，所以基准结果按主机名分别保存，只和本机的基准结果比较。
+长微博的请求和Mastodon都被替换掉，不会访问网络。计时前先检查toot_length等函数的结果，
+不对时直接报错。
+
+用法：
+python benchmarks/bench_parse.py            运行并与基准结果比较
+python benchmarks/bench_parse.py --save     运行并把结果保存为本机新的基准结果
+python benchmarks/bench_parse.py --max-slowdown 20
+                                            比基准结果慢20%以上时退出码为1
+"""
+
+import argparse
+import os
+import platform
+import sys
+import timeit
+import tracemalloc
+
+BENCH_DIR = os.path.split(os.path.realpath(__file__))[0]
+BASELINE_FILE = os.path.join(BENCH_DIR, 'baseline.json')
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import weibo  # noqa: E402
+import xpost  # noqa: E402
+
+from bench_json import read_corpus, slice_detail  # noqa: E402
+
+
+class StubMastodon:
+    """只记录嘟文，不访问网络的Mastodon"""
+    def __init__(self):
+        self.count = 0
+
+    def status_post(self, text, in_reply_to_id=None, media_ids=None):
+        self.count += 1
+        return {'id': self.count}
+
+
+def make_crawler():
+    config = {
+        'user_id_list': ['1669879400'],
+        'filter': 0,
+        'since_date': '2000-01-01',
+        'write_mode': ['csv'],
+        'original_pic_download': 0,
+        'retweet_pic_download': 0,
+        'original_video_download': 0,
+        'retweet_video_download': 0,
+    }
+    return weibo.Weibo(config)
+
+
+def get_cases():
+    wb = make_crawler()
+    cards = [
+        card for card in weibo.json_loads(read_corpus('getindex_page.json'))
+        ['data']['cards'] if card['card_type'] == 9
+    ]
+    mblogs = [card['mblog'] for card in cards]
+    mblogs += [m['retweeted_status'] for m in mblogs if 'retweeted_status' in m]
+    long_status = weibo.json_loads(
+        slice_detail(read_corpus('detail_page.html').decode('utf-8')))['status']
+    # 不请求长微博，直接解析录好的详情页
+    wb.get_long_weibo = lambda id: wb.parse_weibo(long_status)
+
+    from lxml import etree
+    selectors = [(etree.HTML(m['text']), wb.get_pics(m) + wb.get_video_url(m))
+                 for m in mblogs]
+    infos = [wb.parse_weibo(m) for m in mblogs]
+    dates = [m['created_at'] for m in mblogs] + [
+        u'刚刚', u'5分钟前', u'3小时前', u'昨天 12:00'
+    ]
+
+    posts = []
+    for card in cards:
+        post = wb.get_one_weibo(card)
+        post['created_at'] = wb.standardize_date(card['mblog']['created_at'])
+        posts.append(post)
+    xpost.DATABASE_FILE = ':memory:'
+    db = xpost.get_db()
+    # 不读取实例的限制，使用缓存的值
+    db.execute('INSERT INTO InstanceLimits VALUES (?,?,?)',
+               ('https://mastodon.example', '{}', 2 ** 40))
+    user_id = str(posts[0]['user_id'])
+    target = {'name': '', 'url': 'https://mastodon.example',
+              'mast': StubMastodon()}
+    config = {
+        'user_list': [{'id': user_id}],
+        'mastodon_instance_url': 'https://mastodon.example',
+        'toot_len_limit': 500,
+        'max_attachment_count': 4,
+        'include_repost': True,
+        'external_media': True,
+        'standalone_repost': False,
+        'include_post_url': False,
+    }
+
+    return [
+        ('parse_weibo', len(mblogs),
+         lambda: [wb.parse_weibo(m) for m in mblogs]),
+        ('get_text_body', len(selectors),
+         lambda: [wb.get_text_body(s, media) for s, media in selectors]),
+        ('standardize_info', len(infos),
+         lambda: [wb.standardize_info(dict(info)) for info in infos]),
+        ('standardize_date', len(dates),
+         lambda: [wb.standardize_date(d) for d in dates]),
+        ('get_video_url', len(mblogs),
+         lambda: [wb.get_video_url(m) for m in mblogs]),
+        ('get_one_weibo', len(cards),
+         lambda: [wb.get_one_weibo(card) for card in cards]),
+        ('cross_post', len(posts),
+         lambda: [xpost.cross_post(p, target, config, db) for p in posts]),
+    ]
+
+
+def check_cases():
+    """检查计时的代码结果是否正确，结果不对时计时也没有意义"""
+    # get_text_body生成的「网页链接」后面紧跟着正文，URL不能把后面的中文也算进去
+    glued = u'看这里https://t.cn/A6abcd' + u'中' * 600
+    for text, expected in [(glued, 626), (u'见https://m.weibo.cn/detail/1。', 25),
+                           (u'(https://a.com/x?y=1)', 25)]:
+        length = xpost.toot_length(text)
+        if length != expected:
+            raise AssertionError(u'toot_length(%r)是%d，应该是%d' %
+                                 (text[:40], length, expected))
+    length = xpost.toot_length(xpost.truncate_toot(glued, 450))
+    if length != 450:
+        raise AssertionError(u'截断到450字后还有%d字' % length)
+
+
+def measure(func, calls, number):
+    """返回(每次调用的微秒数, 每次调用分配的KiB)"""
+    func()  # 预热，例如让正则表达式先编译好
+    best = min(timeit.repeat(func, number=number, repeat=5))
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func()
+        peak = tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return best / number / calls * 1e6, peak / calls / 1024
+
+
+def load_baselines():
+    """返回{主机名: {测试名: 结果}}"""
+    if not os.path.isfile(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE, 'rb') as f:
+        return weibo.json_loads(f.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=20,
+                        help=u'每轮运行的次数')
+    parser.add_argument('--save', action='store_true',
+                        help=u'把结果保存为本机新的基准结果')
+    parser.add_argument('--max-slowdown', type=float,
+                        help=u'允许比基准结果慢的百分比，超过时退出码为1')
+    args = parser.parse_args()
+
+    check_cases()
+    host = platform.node()
+    baselines = load_baselines()
+    baseline = baselines.get(host, {})
+    if not baseline:
+        print(u'没有%s的基准结果，可以用--save保存' % host)
+    results = {}
+    slow = []
+    print('%-18s%12s%12s%12s%12s' %
+          ('case', 'us/call', 'baseline', 'change', 'KiB/call'))
+    for name, calls, func in get_cases():
+        usec, kib = measure(func, calls, args.number)
+        results[name] = {'usec': round(usec, 2), 'kib': round(kib, 2)}
+        old = baseline.get(name)
+        if old:
+            change = (usec / old['usec'] - 1) * 100
+            row = '%12.1f%11.1f%%' % (old['usec'], change)
+            if args.max_slowdown is not None and change > args.max_slowdown:
+                slow.append(name)
+        else:
+            row = '%12s%12s' % ('-', '-')
+        print('%-18s%12.1f%s%12.2f' % (name, usec, row, kib))
+
+    if args.save:
+        baselines[host] = results
+        with open(BASELINE_FILE, 'wb') as f:
+            f.write(weibo.json_dumps(baselines, sort_keys=True))
+        print(u'%s的基准结果已保存到%s' % (host, BASELINE_FILE))
+    if slow:
+        print(u'比基准结果慢了%s%%以上：%s' % (args.max_slowdown, ', '.join(slow)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,37 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import argparse
+import atexit
 import codecs
 import copy
 import csv
+import hashlib
 import json
 import logging
 import logging.config
+import logging.handlers
 import math
 import os
-import random
+import queue
 import sys
+import threading
 import warnings
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date, datetime, timedelta
-from time import sleep
+from time import sleep, time
 import re
+import sqlite3
+from urllib.parse import parse_qs, urlparse
 
 import requests
-from lxml import etree
 from requests.adapters import HTTPAdapter
-from tqdm import tqdm
+
+try:
+    import orjson  # 可选，安装后解析和生成json更快
+except ImportError:
+    orjson = None
 
 warnings.filterwarnings("ignore")
 
@@ -30,6 +41,650 @@ logging.config.fileConfig(logging_path)
 logger = logging.getLogger('weibo')
 
 
+def start_queue_logging():
+    """把logging.conf中配置的handler移到后台线程
+
+    各logger只保留一个QueueHandler，日志记录放入队列后立即返回，由QueueListener
+    在后台线程中写终端和文件，写日志不会阻塞抓取和转发。程序退出时写完队列中剩余的日志
+    """
+    queue_handlers = {}  # 同一组handler共用一个队列
+    loggers = [logging.getLogger()] + [
+        lg for lg in logging.Logger.manager.loggerDict.values()
+        if isinstance(lg, logging.Logger)
+    ]
+    for lg in loggers:
+        handlers = tuple(h for h in lg.handlers
+                         if not isinstance(h, logging.handlers.QueueHandler))
+        if not handlers:
+            continue
+        if handlers not in queue_handlers:
+            log_queue = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(
+                log_queue, *handlers, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+            queue_handlers[handlers] = logging.handlers.QueueHandler(log_queue)
+        for handler in handlers:
+            lg.removeHandler(handler)
+        lg.addHandler(queue_handlers[handlers])
+
+
+start_queue_logging()
+
+
+def json_loads(data):
+    """解析json字符串或bytes，安装了orjson时使用orjson
+
+    orjson不接受的内容（如字符串中的控制字符、超出64位的整数）交给标准库json解析
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data, strict=False)
+
+
+def json_dumps(obj, sort_keys=False, default=None):
+    """把obj转为utf-8编码的json bytes，不转义非ASCII字符，安装了orjson时使用orjson"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj, default=default, option=option)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj,
+                      ensure_ascii=False,
+                      sort_keys=sort_keys,
+                      default=default,
+                      separators=(',', ':')).encode('utf-8')
+
+
+class CsvWriter(object):
+    """在整个运行期间保持csv文件打开，缓存待写入的行，攒够一定行数或时间后批量写入"""
+    def __init__(self, flush_rows=1000, flush_interval=30):
+        self.flush_rows = flush_rows  # 缓存行数达到该值时写入文件
+        self.flush_interval = flush_interval  # 距上次写入超过该秒数时写入文件
+        self.files = {}  # 文件路径到已打开文件的映射
+        self.buffers = {}  # 文件路径到待写入行列表的映射
+        self.last_rows = {}  # 文件路径到{首列值: 最近写入行}的映射，用于去重
+        self.last_flush = time()
+        atexit.register(self.close)
+
+    def writerows(self, file_path, headers, rows, unique=False):
+        """缓存要写入file_path的行，unique为True时跳过与上次内容相同的行(以首列为键)"""
+        if file_path not in self.files:
+            is_first_write = not os.path.isfile(file_path)
+            self.files[file_path] = open(file_path,
+                                         'a',
+                                         encoding='utf-8-sig',
+                                         newline='')
+            self.buffers[file_path] = [headers] if is_first_write else []
+            self.last_rows[file_path] = {}
+        buffer = self.buffers[file_path]
+        last_rows = self.last_rows[file_path]
+        for row in rows:
+            row = list(row)
+            if unique:
+                if last_rows.get(row[0]) == row:
+                    continue
+                last_rows[row[0]] = row
+            buffer.append(row)
+        if (sum(len(b) for b in self.buffers.values()) >= self.flush_rows
+                or time() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """将所有缓存的行写入文件"""
+        for file_path, buffer in self.buffers.items():
+            if buffer:
+                f = self.files[file_path]
+                csv.writer(f).writerows(buffer)
+                f.flush()
+                del buffer[:]
+        self.last_flush = time()
+
+    def close(self):
+        """写入缓存的行并关闭所有文件"""
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self.buffers = {}
+        self.last_rows = {}
+
+
+csv_writer = CsvWriter()
+
+
+class MongoWriter(object):
+    """在整个运行期间共用一个MongoClient，按页批量upsert，跳过内容没有变化的文档"""
+    def __init__(self):
+        self.client = None
+        self.collections = {}  # 集合名到已创建索引的集合的映射
+        self.hashes = {}  # 集合名到{id: 最近写入内容的哈希值}的映射
+
+    def get_collection(self, name):
+        """获取集合，首次使用时创建id唯一索引"""
+        if name not in self.collections:
+            import pymongo
+            if self.client is None:
+                self.client = pymongo.MongoClient()
+            collection = self.client['weibo'][name]
+            try:
+                collection.create_index('id', unique=True)
+            except pymongo.errors.OperationFailure as e:
+                logger.warning(u'无法为%s创建id唯一索引：%s', name, e)
+            self.collections[name] = collection
+            self.hashes[name] = {}
+        return self.collections[name]
+
+    def upsert(self, name, info_list):
+        """将info_list批量插入或更新到集合name中"""
+        from pymongo import UpdateOne
+
+        collection = self.get_collection(name)
+        hashes = self.hashes[name]
+        operations = []
+        new_hashes = {}
+        for info in info_list:
+            content_hash = hashlib.md5(
+                json_dumps(info, sort_keys=True, default=str)).hexdigest()
+            if hashes.get(info['id']) == content_hash:
+                continue
+            new_hashes[info['id']] = content_hash
+            operations.append(
+                UpdateOne({'id': info['id']}, {'$set': info}, upsert=True))
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+            hashes.update(new_hashes)
+
+
+mongo_writer = MongoWriter()
+
+
+class MysqlWriter(object):
+    """在整个运行期间共用一个MySQL连接，建表语句只执行一次，分块在同一事务中写入"""
+    def __init__(self):
+        self.connection = None
+        self.executed_sql = set()  # 本次运行已经执行过的建库、建表语句
+
+    def connect(self, mysql_config):
+        """获取MySQL连接，首次调用时建立连接，之后若连接断开则自动重连"""
+        import pymysql
+
+        if self.connection is None:
+            self.connection = pymysql.connect(**mysql_config)
+        else:
+            self.connection.ping(reconnect=True)
+        return self.connection
+
+    def execute_once(self, mysql_config, sql):
+        """执行建表语句，同一语句在本次运行中只执行一次"""
+        if sql not in self.executed_sql:
+            with self.connect(mysql_config).cursor() as cursor:
+                cursor.execute(sql)
+            self.executed_sql.add(sql)
+
+    def insert(self, mysql_config, table, data_list, chunk_size):
+        """每chunk_size条一批插入或更新数据，全部写完后一起提交"""
+        connection = self.connect(mysql_config)
+        keys = list(data_list[0].keys())
+        sql = """INSERT INTO {table}({keys}) VALUES ({values}) ON
+                 DUPLICATE KEY UPDATE""".format(table=table,
+                                                keys=', '.join(keys),
+                                                values=', '.join(['%s'] *
+                                                                 len(keys)))
+        sql += ','.join(
+            [' {key} = values({key})'.format(key=key) for key in keys])
+        try:
+            with connection.cursor() as cursor:
+                for i in range(0, len(data_list), chunk_size):
+                    cursor.executemany(sql, [
+                        tuple(data.get(key) for key in keys)
+                        for data in data_list[i:i + chunk_size]
+                    ])
+            connection.commit()
+        except Exception as e:
+            connection.rollback()
+            logger.exception(e)
+
+
+mysql_writer = MysqlWriter()
+
+
+class SqliteWriter(object):
+    """在整个运行期间共用一个WAL模式的SQLite连接，每次写入在一个事务中批量upsert"""
+    weibo_columns = [
+        'id', 'bid', 'user_id', 'screen_name', 'text', 'article_url',
+        'topics', 'at_users', 'pics', 'video_url', 'location', 'created_at',
+        'source', 'attitudes_count', 'comments_count', 'reposts_count',
+        'retweet_id'
+    ]
+    user_columns = [
+        'id', 'screen_name', 'gender', 'birthday', 'location', 'education',
+        'company', 'registration_time', 'sunshine', 'statuses_count',
+        'followers_count', 'follow_count', 'description', 'profile_url',
+        'profile_image_url', 'avatar_hd', 'urank', 'mbrank', 'verified',
+        'verified_type', 'verified_reason'
+    ]
+
+    def __init__(self):
+        self.connection = None
+        self.has_fts = False  # 全文索引表是否可用
+        self.has_bigram = False  # 短关键词的索引表是否可用
+
+    def connect(self, path):
+        """获取SQLite连接，首次调用时建立连接并创建表"""
+        if self.connection is None:
+            connection = sqlite3.connect(path, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS weibo (
+                id INTEGER PRIMARY KEY,
+                bid TEXT,
+                user_id INTEGER,
+                screen_name TEXT,
+                text TEXT,
+                article_url TEXT,
+                topics TEXT,
+                at_users TEXT,
+                pics TEXT,
+                video_url TEXT,
+                location TEXT,
+                created_at TEXT,
+                source TEXT,
+                attitudes_count INTEGER,
+                comments_count INTEGER,
+                reposts_count INTEGER,
+                retweet_id INTEGER);
+                CREATE INDEX IF NOT EXISTS weibo_user_created
+                ON weibo (user_id, created_at);
+                CREATE TABLE IF NOT EXISTS user (
+                id INTEGER PRIMARY KEY,
+                screen_name TEXT,
+                gender TEXT,
+                birthday TEXT,
+                location TEXT,
+                education TEXT,
+                company TEXT,
+                registration_time TEXT,
+                sunshine TEXT,
+                statuses_count INTEGER,
+                followers_count INTEGER,
+                follow_count INTEGER,
+                description TEXT,
+                profile_url TEXT,
+                profile_image_url TEXT,
+                avatar_hd TEXT,
+                urank INTEGER,
+                mbrank INTEGER,
+                verified BOOLEAN,
+                verified_type INTEGER,
+                verified_reason TEXT);""")
+            try:
+                # trigram分词可以直接匹配中文子串，rowid即微博id
+                connection.execute("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS weibo_fts USING fts5(
+                    text, topics, at_users,
+                    user_id UNINDEXED, screen_name UNINDEXED,
+                    created_at UNINDEXED, tokenize='trigram')""")
+                self.has_fts = True
+                self.create_bigram_index(connection)
+            except sqlite3.OperationalError as e:
+                logger.warning(u'当前SQLite不支持FTS5全文索引：%s', e)
+            self.connection = connection
+        return self.connection
+
+    def create_bigram_index(self, connection):
+        """创建短关键词使用的weibo_bigram表，已有全文索引时用其内容填充"""
+        exists = connection.execute(
+            """SELECT 1 FROM sqlite_master
+               WHERE type = 'table' AND name = 'weibo_bigram'""").fetchone()
+        if not exists:
+            connection.create_function('bigrams', 1, bigrams)
+            with connection:
+                connection.execute("""
+                    CREATE VIRTUAL TABLE weibo_bigram USING fts5(
+                    text, topics, at_users, tokenize='unicode61')""")
+                connection.execute(
+                    """INSERT INTO weibo_bigram(rowid, text, topics, at_users)
+                       SELECT rowid, bigrams(text), bigrams(topics),
+                       bigrams(at_users) FROM weibo_fts""")
+        self.has_bigram = True
+
+    def upsert(self, path, table, columns, data_list):
+        """在一个事务中插入或更新data_list，只写入columns中的字段"""
+        connection = self.connect(path)
+        sql = """INSERT INTO {table}({keys}) VALUES ({values})
+                 ON CONFLICT(id) DO UPDATE SET {update}""".format(
+            table=table,
+            keys=', '.join(columns),
+            values=', '.join(['?'] * len(columns)),
+            update=', '.join(
+                ['{key} = excluded.{key}'.format(key=key) for key in columns]))
+        with connection:
+            connection.executemany(
+                sql, [tuple(data.get(key) for key in columns)
+                      for data in data_list])
+
+    def index(self, path, data_list):
+        """在一个事务中将data_list的正文、话题和@用户写入全文索引"""
+        connection = self.connect(path)
+        if not self.has_fts:
+            return
+        with connection:
+            connection.executemany('DELETE FROM weibo_fts WHERE rowid = ?',
+                                   [(data['id'], ) for data in data_list])
+            connection.executemany(
+                """INSERT INTO weibo_fts(rowid, text, topics, at_users,
+                   user_id, screen_name, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                [(data['id'], data.get('text'), data.get('topics'),
+                  data.get('at_users'), str(data.get('user_id', '')),
+                  data.get('screen_name'), data.get('created_at'))
+                 for data in data_list])
+            if self.has_bigram:
+                connection.executemany(
+                    'DELETE FROM weibo_bigram WHERE rowid = ?',
+                    [(data['id'], ) for data in data_list])
+                connection.executemany(
+                    """INSERT INTO weibo_bigram(rowid, text, topics, at_users)
+                       VALUES (?, ?, ?, ?)""",
+                    [(data['id'], bigrams(data.get('text')),
+                      bigrams(data.get('topics')),
+                      bigrams(data.get('at_users'))) for data in data_list])
+
+
+sqlite_writer = SqliteWriter()
+
+
+def bigrams(text):
+    """把text中每段连续的文字拆成相邻两个字组成的词，用空格隔开，每段最后一个字单独成词
+
+    trigram索引无法匹配少于3个字的关键词，这样写入weibo_bigram表后，
+    两个字的关键词可以作为一个词、一个字的关键词可以作为前缀在索引中查找
+    """
+    words = []
+    for run in re.findall(r'[^\W_]+', text or ''):
+        words += [run[i:i + 2] for i in range(len(run) - 1)] + [run[-1]]
+    return ' '.join(words)
+
+
+class DownloadQueue(object):
+    """记录下载失败的文件，按指数退避的时间重试，404/410的文件不再重试"""
+    retry_delay = 60  # 第一次重试前等待的秒数，之后每次翻倍
+    max_retry_delay = 24 * 3600  # 两次重试之间最多等待的秒数
+    max_attempts = 10  # 失败这么多次后不再自动重试
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS download_queue (
+            url TEXT PRIMARY KEY,
+            file_path TEXT,
+            type TEXT,
+            weibo_id TEXT,
+            attempts INTEGER,
+            next_retry REAL,
+            status TEXT,
+            error TEXT)""")
+        self.queued = set()  # 队列中的全部url
+        self.gone = set()  # 已确认不存在的url
+        for url, status in self.connection.execute(
+                'SELECT url, status FROM download_queue'):
+            self.queued.add(url)
+            if status == 'gone':
+                self.gone.add(url)
+
+    def push(self, url, file_path, type, weibo_id, error):
+        """记录一次下载失败，安排下一次重试"""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT attempts FROM download_queue WHERE url = ?',
+                [url]).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            delay = min(self.retry_delay * 2**(attempts - 1),
+                        self.max_retry_delay)
+            status = 'pending' if attempts < self.max_attempts else 'failed'
+            with self.connection:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO download_queue VALUES (?,?,?,?,?,?,?,?)',
+                    (url, file_path, type, str(weibo_id), attempts,
+                     time() + delay, status, str(error)))
+            self.queued.add(url)
+
+    def mark_gone(self, url, file_path, type, weibo_id, error):
+        """记录已经不存在的文件，以后不再下载"""
+        with self.lock:
+            with self.connection:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO download_queue VALUES (?,?,?,?,?,?,?,?)',
+                    (url, file_path, type, str(weibo_id), 1, None, 'gone',
+                     str(error)))
+            self.queued.add(url)
+            self.gone.add(url)
+
+    def remove(self, url):
+        """下载成功后把url移出队列"""
+        with self.lock:
+            if url in self.queued:
+                with self.connection:
+                    self.connection.execute(
+                        'DELETE FROM download_queue WHERE url = ?', [url])
+                self.queued.discard(url)
+
+    def due(self):
+        """返回已到重试时间的(url, 文件路径, 类型, 微博id)列表"""
+        with self.lock:
+            return self.connection.execute(
+                """SELECT url, file_path, type, weibo_id FROM download_queue
+                   WHERE status = 'pending' AND next_retry <= ?""",
+                [time()]).fetchall()
+
+
+class BlobStore(object):
+    """按内容存储图片/视频，同一个文件只下载、保存一次，各用户目录下的文件是指向它的硬链接"""
+    def __init__(self, path, blob_dir):
+        self.lock = threading.Lock()
+        self.blob_dir = blob_dir
+        self.connection = sqlite3.connect(path,
+                                          timeout=30,
+                                          check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS blob (
+            url_key TEXT PRIMARY KEY,
+            blob_key TEXT)""")
+        # 以前所有实况照片都用了这个键，指向的是第一张实况照片
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM blob WHERE url_key = 'video.weibo.com/media/play'")
+        self.index = dict(
+            self.connection.execute('SELECT url_key, blob_key FROM blob'))
+
+    def get_url_key(self, url):
+        """获取url对应的索引键
+
+        新浪图床的文件名本身就是文件id，实况照片按livephoto参数指向的新浪图床文件处理；
+        其它url使用域名和路径，忽略每次都会变的查询参数（如视频地址里的签名和过期时间）
+        """
+        url = urlparse(url)
+        livephoto = parse_qs(url.query).get('livephoto')
+        if livephoto:
+            url = urlparse(livephoto[0])
+        if url.netloc.endswith('sinaimg.cn'):
+            return 'sinaimg:' + url.path.split('/')[-1]
+        return url.netloc + url.path
+
+    def get_blob_path(self, blob_key):
+        """获取blob_key对应的文件路径"""
+        return os.path.join(self.blob_dir, blob_key[:2], blob_key)
+
+    def lookup(self, url):
+        """返回url对应的已保存文件路径，没有则返回None"""
+        url_key = self.get_url_key(url)
+        if url_key.startswith('sinaimg:'):
+            blob_key = url_key[len('sinaimg:'):]
+        else:
+            blob_key = self.index.get(url_key)
+        if blob_key:
+            blob_path = self.get_blob_path(blob_key)
+            if os.path.isfile(blob_path):
+                return blob_path
+
+    def link(self, blob_path, file_path):
+        """在file_path创建指向blob_path的硬链接，不支持硬链接时改用符号链接"""
+        if os.path.lexists(file_path):
+            return
+        try:
+            os.link(blob_path, file_path)
+        except OSError:
+            os.symlink(os.path.abspath(blob_path), file_path)
+
+    def add(self, url, src_path, file_path):
+        """把下载好的src_path存入仓库，并链接到file_path"""
+        url_key = self.get_url_key(url)
+        if url_key.startswith('sinaimg:'):
+            blob_key = url_key[len('sinaimg:'):]
+        else:
+            sha1 = hashlib.sha1()
+            with open(src_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    sha1.update(chunk)
+            blob_key = sha1.hexdigest() + os.path.splitext(
+                urlparse(url).path)[1]
+        blob_path = self.get_blob_path(blob_key)
+        with self.lock:
+            if os.path.isfile(blob_path):
+                os.remove(src_path)
+            else:
+                if not os.path.isdir(os.path.dirname(blob_path)):
+                    os.makedirs(os.path.dirname(blob_path))
+                os.replace(src_path, blob_path)
+            if not url_key.startswith('sinaimg:') and self.index.get(
+                    url_key) != blob_key:
+                with self.connection:
+                    self.connection.execute(
+                        'INSERT OR REPLACE INTO blob VALUES (?, ?)',
+                        (url_key, blob_key))
+                self.index[url_key] = blob_key
+            self.link(blob_path, file_path)
+
+
+class RequestGovernor(object):
+    """所有线程共用的自适应请求限速（AIMD）
+
+    请求正常时每次把速度加快add_rate次/秒，被限制（403、418、429，提示请求过于频繁，
+    返回的内容无法解析，超时）时把速度减半。没有更多微博、用户不存在等正常返回的ok为0
+    不算被限制。速度在min_rate和max_rate之间，学到的速度保存在path中，下次运行时继续使用。
+    """
+    add_rate = 0.01  # 每次请求成功后增加的速度
+    save_every = 20  # 每成功多少次请求保存一次速度
+    limited_status = (403, 418, 429)  # 代表被限制的HTTP状态码
+    limited_msg = (u'频繁', u'稍后再试')  # ok为0时代表被限制的提示
+
+    def __init__(self, path, min_interval=1, max_interval=60):
+        self.path = path
+        self.max_rate = 1.0 / min_interval
+        self.min_rate = 1.0 / max_interval
+        self.rate = self.max_rate / 3  # 请求速度，单位为次/秒
+        self.next_time = 0  # 下一次请求最早可以发出的时间
+        self.success_count = 0
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # 各线程共用同一个临时文件，一次只能有一个线程保存
+        try:
+            with open(path, 'rb') as f:
+                self.rate = float(json_loads(f.read())['rate'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        self.rate = min(max(self.rate, self.min_rate), self.max_rate)
+
+    def wait(self):
+        """等待到可以发出下一次请求为止"""
+        with self.lock:
+            now = time()
+            request_time = max(self.next_time, now)
+            self.next_time = request_time + 1.0 / self.rate
+        if request_time > now:
+            sleep(request_time - now)
+
+    def success(self):
+        """请求正常，加快速度"""
+        with self.lock:
+            self.rate = min(self.rate + self.add_rate, self.max_rate)
+            self.success_count += 1
+            if self.success_count % self.save_every:
+                return
+        self.save()
+
+    def is_limited(self, js):
+        """判断ok为0的返回结果是否代表被限制"""
+        msg = js.get('msg') or ''
+        return any(keyword in msg for keyword in self.limited_msg)
+
+    def failure(self):
+        """请求被限制，速度减半，并推迟下一次请求"""
+        with self.lock:
+            self.rate = max(self.rate / 2, self.min_rate)
+            self.next_time = max(self.next_time, time() + 1.0 / self.rate)
+            logger.warning(u'请求被限制，降低请求速度到每%.1f秒一次', 1.0 / self.rate)
+        self.save()
+
+    def save(self):
+        """保存学到的请求速度"""
+        with self.save_lock:
+            with self.lock:
+                data = {'rate': self.rate}
+            try:
+                with open(self.path + '.tmp', 'wb') as f:
+                    f.write(json_dumps(data))
+                os.replace(self.path + '.tmp', self.path)
+            except OSError as e:
+                logger.warning(u'无法保存请求速度: %s', e)
+
+
+def search_weibo(path, query, user_id=None, since=None, until=None,
+                 limit=20):
+    """在全文索引中搜索微博，返回(微博id, 用户昵称, 发布时间, 正文)列表"""
+    connection = sqlite3.connect(path)
+    try:
+        has_bigram = connection.execute(
+            """SELECT 1 FROM sqlite_master
+               WHERE type = 'table' AND name = 'weibo_bigram'""").fetchone()
+        if len(query) >= 3:
+            condition = 'weibo_fts MATCH ?'
+            params = ['"' + query.replace('"', '""') + '"']
+        elif has_bigram and query.isalnum():
+            # 两个字的关键词是weibo_bigram中的一个词，一个字的关键词是词的前缀
+            condition = ('rowid IN (SELECT rowid FROM weibo_bigram '
+                         'WHERE weibo_bigram MATCH ?)')
+            params = ['"' + query + '"' + ('*' if len(query) == 1 else '')]
+        else:
+            # 含空格、标点的短关键词无法用索引，只能逐条比较
+            condition = '(text LIKE ? OR topics LIKE ? OR at_users LIKE ?)'
+            params = ['%' + query + '%'] * 3
+        if user_id:
+            condition += ' AND user_id = ?'
+            params.append(str(user_id))
+        if since:
+            condition += ' AND created_at >= ?'
+            params.append(since)
+        if until:
+            condition += ' AND created_at <= ?'
+            params.append(until)
+        params.append(limit)
+        return connection.execute(
+            """SELECT rowid, screen_name, created_at, text FROM weibo_fts
+               WHERE {} ORDER BY created_at DESC LIMIT ?""".format(condition),
+            params).fetchall()
+    finally:
+        connection.close()
+
+
 class Weibo(object):
     def __init__(self, config):
         """Weibo类初始化"""
@@ -43,7 +698,9 @@ class Weibo(object):
         self.since_date = since_date  # 起始时间，即爬取发布日期从该值到现在的微博，形式为yyyy-mm-dd
         self.start_page = config.get('start_page', 1)  # 开始爬的页，如果中途被限制而结束可以用此定义开始页码
         self.write_mode = config[
-            'write_mode']  # 结果信息保存类型，为list形式，可包含csv、mongo和mysql三种类型
+            'write_mode']  # 结果信息保存类型，为list形式，可包含csv、json、jsonl、mongo、mysql和sqlite
+        self.jsonl_compact = config.get(
+            'jsonl_compact', 0)  # 取值范围为0、1,1代表jsonl结果文件中过期记录过多时自动压缩
         self.original_pic_download = config[
             'original_pic_download']  # 取值范围为0、1, 0代表不下载原创微博图片,1代表下载
         self.retweet_pic_download = config[
@@ -54,15 +711,47 @@ class Weibo(object):
             'retweet_video_download']  # 取值范围为0、1, 0代表不下载转发微博视频,1代表下载
         self.result_dir_name = config.get(
             'result_dir_name', 0)  # 结果目录名，取值为0或1，决定结果文件存储在用户昵称文件夹里还是用户id文件夹里
+        self.download_workers = config.get('download_workers',
+                                           8)  # 同时下载图片/视频的线程数
+        self.download_host_limit = config.get(
+            'download_host_limit', 4)  # 对同一个域名同时进行的下载数上限
+        self.session = requests.Session()  # 所有下载共用的连接池
+        adapter = HTTPAdapter(pool_maxsize=self.download_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.host_semaphores = {}  # 域名到限制该域名同时下载数的信号量的映射
+        self.download_queue = None  # 下载失败待重试的文件队列
+        self.dedup_media = config.get(
+            'dedup_media', 0)  # 取值范围为0、1,1代表相同的图片/视频只下载、保存一次
+        self.blob_store = None  # 按内容保存图片/视频的仓库
+        self.download_lock = threading.Lock()
         cookie = config.get('cookie')  # 微博cookie，可填可不填
         user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.111 Safari/537.36'
         self.headers = {'User_Agent': user_agent, 'Cookie': cookie}
         self.mysql_config = config.get('mysql_config')  # MySQL数据库连接配置，可以不填
+        self.mysql_chunk_size = config.get(
+            'mysql_chunk_size', 500)  # 写入MySQL时每批插入的行数
+        self.sqlite_path = config.get(
+            'sqlite_path') or 'weibo.sqlite3'  # SQLite数据库文件路径，相对路径基于weibo文件夹
+        self.search_index = config.get(
+            'search_index', 0)  # 取值范围为0、1,1代表把微博写入SQLite数据库中的全文索引
         user_id_list = config['user_id_list']
         query_list = config.get('query_list') or []
         if isinstance(query_list, str):
             query_list = query_list.split(',')
         self.query_list = query_list
+        self.query_workers = config.get(
+            'query_workers', 4)  # 同时爬取同一用户多个关键词的线程数
+        file_dir = os.path.split(os.path.realpath(__file__))[0] + os.sep + 'weibo'
+        if not os.path.isdir(file_dir):
+            os.makedirs(file_dir)
+        self.request_governor = RequestGovernor(
+            file_dir + os.sep + 'throttle.json',
+            config.get('request_interval', 1),  # 两次请求之间至少间隔的秒数
+            config.get('max_request_interval',
+                       60))  # 被限制时两次请求之间最多间隔的秒数
+        self.crawl_lock = threading.Lock()  # 多个关键词线程共用的去重集合的锁
+        self.write_lock = threading.Lock()  # 多个关键词线程共用的写入文件或数据库的锁
         if not isinstance(user_id_list, list):
             if not os.path.isabs(user_id_list):
                 user_id_list = os.path.split(
@@ -82,8 +771,11 @@ class Weibo(object):
         self.query = ''
         self.user = {}  # 存储目标微博用户信息
         self.got_count = 0  # 存储爬取到的微博数
+        self.failed_count = 0  # 解析失败、没有获取到的微博数
         self.weibo = []  # 存储爬取到的所有微博信息
-        self.weibo_id_list = []  # 存储爬取到的所有微博id
+        self.weibo_id_list = set()  # 存储爬取到的所有微博id
+        self.jsonl_index = {}  # jsonl结果文件路径到{微博id: 行偏移量}索引的映射
+        self.jsonl_stale = {}  # jsonl结果文件中已被新记录覆盖的行数
 
     def validate_config(self, config):
         """验证配置是否正确"""
@@ -113,13 +805,13 @@ class Weibo(object):
             sys.exit()
 
         # 验证write_mode
-        write_mode = ['csv', 'json', 'mongo', 'mysql']
+        write_mode = ['csv', 'json', 'jsonl', 'mongo', 'mysql', 'sqlite']
         if not isinstance(config['write_mode'], list):
             sys.exit(u'write_mode值应为list类型')
         for mode in config['write_mode']:
             if mode not in write_mode:
                 logger.warning(
-                    u'%s为无效模式，请从csv、json、mongo和mysql中挑选一个或多个作为write_mode',
+                    u'%s为无效模式，请从csv、json、jsonl、mongo、mysql和sqlite中挑选一个或多个作为write_mode',
                     mode)
                 sys.exit()
 
@@ -148,11 +840,24 @@ class Weibo(object):
     def get_json(self, params):
         """获取网页中json数据"""
         url = 'https://m.weibo.cn/api/container/getIndex?'
-        r = requests.get(url,
-                         params=params,
-                         headers=self.headers,
-                         verify=False)
-        return r.json()
+        self.request_governor.wait()
+        try:
+            r = requests.get(url,
+                             params=params,
+                             headers=self.headers,
+                             verify=False,
+                             timeout=20)
+            if r.status_code in self.request_governor.limited_status:
+                r.raise_for_status()
+            js = json_loads(r.content)
+        except (requests.exceptions.RequestException, ValueError):
+            self.request_governor.failure()
+            raise
+        if js.get('ok') or not self.request_governor.is_limited(js):
+            self.request_governor.success()
+        else:
+            self.request_governor.failure()
+        return js
 
     def get_weibo_json(self, page):
         """获取网页中微博json数据"""
@@ -183,7 +888,7 @@ class Weibo(object):
             v.encode('utf-8') if 'unicode' in str(type(v)) else v
             for v in self.user.values()
         ]]
-        self.csv_helper(result_headers, result_data, file_path)
+        self.csv_helper(result_headers, result_data, file_path, unique=True)
 
     def user_to_mongodb(self):
         """将爬取的用户信息写入MongoDB数据库"""
@@ -234,11 +939,27 @@ class Weibo(object):
         self.mysql_insert(mysql_config, 'user', [self.user])
         logger.info(u'%s信息写入MySQL数据库完毕', self.user['screen_name'])
 
+    def get_sqlite_path(self):
+        """获取SQLite数据库文件路径"""
+        file_dir = os.path.split(
+            os.path.realpath(__file__))[0] + os.sep + 'weibo'
+        if not os.path.isdir(file_dir):
+            os.makedirs(file_dir)
+        return os.path.join(file_dir, self.sqlite_path)
+
+    def user_to_sqlite(self):
+        """将爬取的用户信息写入SQLite数据库"""
+        sqlite_writer.upsert(self.get_sqlite_path(), 'user',
+                             SqliteWriter.user_columns, [self.user])
+        logger.info(u'%s信息写入SQLite数据库完毕', self.user['screen_name'])
+
     def user_to_database(self):
         """将用户信息写入文件/数据库"""
         self.user_to_csv()
         if 'mysql' in self.write_mode:
             self.user_to_mysql()
+        if 'sqlite' in self.write_mode:
+            self.user_to_sqlite()
         if 'mongo' in self.write_mode:
             self.user_to_mongodb()
 
@@ -297,17 +1018,35 @@ class Weibo(object):
         """获取长微博"""
         for i in range(5):
             url = 'https://m.weibo.cn/detail/%s' % id
-            html = requests.get(url, headers=self.headers, verify=False).text
+            self.request_governor.wait()
+            try:
+                r = requests.get(url,
+                                 headers=self.headers,
+                                 verify=False,
+                                 timeout=20)
+            except requests.exceptions.RequestException:
+                self.request_governor.failure()
+                continue
+            if r.status_code in self.request_governor.limited_status:
+                self.request_governor.failure()
+                continue
+            html = r.text
             html = html[html.find('"status":'):]
             html = html[:html.rfind('"hotScheme"')]
             html = html[:html.rfind(',')]
             html = '{' + html + '}'
-            js = json.loads(html, strict=False)
+            try:
+                js = json_loads(html)
+            except ValueError:
+                # 多半是返回了验证页面而不是微博详情
+                self.request_governor.failure()
+                continue
             weibo_info = js.get('status')
             if weibo_info:
+                self.request_governor.success()
                 weibo = self.parse_weibo(weibo_info)
                 return weibo
-            sleep(random.randint(6, 10))
+            self.request_governor.failure()
 
     def get_pics(self, weibo_info):
         """获取微博原始图片url"""
@@ -331,64 +1070,178 @@ class Weibo(object):
                     live_photo_list.append(url)
             return live_photo_list
 
-    def get_video_url(self, weibo_info):
-        """获取微博视频url"""
-        video_url = ''
-        video_url_list = []
+    def get_video_variants(self, weibo_info):
+        """获取微博视频所有清晰度的url，按清晰度从高到低排列"""
+        video_variants = []
         if weibo_info.get('page_info'):
             if weibo_info['page_info'].get('media_info') and weibo_info[
                     'page_info'].get('type') == 'video':
                 media_info = weibo_info['page_info']['media_info']
-                video_url = media_info.get('mp4_720p_mp4')
-                if not video_url:
-                    video_url = media_info.get('mp4_hd_url')
-                    if not video_url:
-                        video_url = media_info.get('mp4_sd_url')
-                        if not video_url:
-                            video_url = media_info.get('stream_url_hd')
-                            if not video_url:
-                                video_url = media_info.get('stream_url')
-        if video_url:
-            video_url_list.append(video_url)
+                for key in [
+                        'mp4_720p_mp4', 'mp4_hd_url', 'mp4_sd_url',
+                        'stream_url_hd', 'stream_url'
+                ]:
+                    url = media_info.get(key)
+                    if url and url not in video_variants:
+                        video_variants.append(url)
+        return video_variants
+
+    def get_video_url(self, weibo_info):
+        """获取微博视频url"""
+        video_url_list = self.get_video_variants(weibo_info)[:1]
         live_photo_list = self.get_live_photo(weibo_info)
         if live_photo_list:
             video_url_list += live_photo_list
         return ';'.join(video_url_list)
 
+    def get_host_semaphore(self, url):
+        """获取限制url所在域名同时下载数的信号量"""
+        host = urlparse(url).netloc
+        with self.download_lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(
+                    self.download_host_limit)
+            return self.host_semaphores[host]
+
+    def get_download_queue(self):
+        """获取下载失败待重试的文件队列"""
+        with self.download_lock:
+            if self.download_queue is None:
+                file_dir = os.path.split(
+                    os.path.realpath(__file__))[0] + os.sep + 'weibo'
+                if not os.path.isdir(file_dir):
+                    os.makedirs(file_dir)
+                self.download_queue = DownloadQueue(file_dir + os.sep +
+                                                    'media.sqlite3')
+            return self.download_queue
+
+    def get_blob_store(self):
+        """获取按内容保存图片/视频的仓库"""
+        with self.download_lock:
+            if self.blob_store is None:
+                file_dir = os.path.split(
+                    os.path.realpath(__file__))[0] + os.sep + 'weibo'
+                if not os.path.isdir(file_dir):
+                    os.makedirs(file_dir)
+                self.blob_store = BlobStore(
+                    file_dir + os.sep + 'media.sqlite3',
+                    file_dir + os.sep + 'blobs')
+            return self.blob_store
+
+    def is_complete_file(self, url, file_path, total_size):
+        """判断下载的文件是否完整"""
+        size = os.path.getsize(file_path)
+        if total_size is not None and size != total_size:
+            return False
+        with open(file_path, 'rb') as f:
+            f.seek(max(size - 4, 0))
+            tail = f.read()
+        if url.endswith(('jpg', 'jpeg')):
+            return tail.endswith(b'\xff\xd9')
+        if url.endswith('png'):
+            return tail.endswith(b'\xaeB`\x82')
+        return size > 0
+
     def download_one_file(self, url, file_path, type, weibo_id):
-        """下载单个文件(图片/视频)"""
+        """下载单个文件(图片/视频)，中断后用Range请求续传，下载完整后才重命名为目标文件"""
+        download_queue = self.get_download_queue()
+        if url in download_queue.gone:
+            return
+        if os.path.isfile(file_path):
+            # 文件可能已由别处下载完成，不要让它一直留在待重试的队列中
+            download_queue.remove(url)
+            return
+        blob_store = self.get_blob_store() if self.dedup_media else None
+        if blob_store:
+            blob_path = blob_store.lookup(url)
+            if blob_path:
+                blob_store.link(blob_path, file_path)
+                download_queue.remove(url)
+                return
+        part_path = file_path + '.part'
         try:
-            if not os.path.isfile(file_path):
-                s = requests.Session()
-                s.mount(url, HTTPAdapter(max_retries=5))
-                flag = True
-                try_count = 0
-                while flag and try_count < 5:
-                    flag = False
-                    downloaded = s.get(url,
-                                       headers=self.headers,
-                                       timeout=(5, 10),
-                                       verify=False)
-                    try_count += 1
-                    if (url.endswith(('jpg', 'jpeg'))
-                            and not downloaded.content.endswith(b'\xff\xd9')
-                        ) or (url.endswith('png') and
-                              not downloaded.content.endswith(b'\xaeB`\x82')):
-                        flag = True
-                with open(file_path, 'wb') as f:
-                    f.write(downloaded.content)
+            with self.get_host_semaphore(url):
+                for try_count in range(5):
+                    offset = os.path.getsize(part_path) if os.path.isfile(
+                        part_path) else 0
+                    headers = dict(self.headers)
+                    if offset:
+                        headers['Range'] = 'bytes=%d-' % offset
+                    total_size = None
+                    try:
+                        with self.session.get(url,
+                                              headers=headers,
+                                              timeout=(5, 10),
+                                              verify=False,
+                                              stream=True) as r:
+                            if r.status_code != 416:
+                                r.raise_for_status()
+                                if r.status_code == 206:
+                                    mode = 'ab'
+                                    total_size = int(r.headers.get(
+                                        'Content-Range', '/0').split('/')[-1]
+                                                     or 0) or None
+                                else:
+                                    mode = 'wb'
+                                    total_size = int(r.headers.get(
+                                        'Content-Length', 0)) or None
+                                with open(part_path, mode) as f:
+                                    for chunk in r.iter_content(64 * 1024):
+                                        f.write(chunk)
+                    except (requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout,
+                            requests.exceptions.ChunkedEncodingError) as e:
+                        logger.warning(u'下载%s中断，准备续传：%s', url, e)
+                        continue
+                    if not os.path.isfile(part_path):
+                        continue
+                    if self.is_complete_file(url, part_path, total_size):
+                        if blob_store:
+                            blob_store.add(url, part_path, file_path)
+                        else:
+                            os.replace(part_path, file_path)
+                        download_queue.remove(url)
+                        return
+                    if total_size is None or os.path.getsize(
+                            part_path) >= total_size:
+                        # 长度已够但内容不完整，只能重新下载
+                        os.remove(part_path)
+                raise IOError(u'%s下载失败或不完整' % url)
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code in (404,
+                                                                      410):
+                download_queue.mark_gone(url, file_path, type, weibo_id, e)
+            else:
+                download_queue.push(url, file_path, type, weibo_id, e)
+            logger.warning(u'下载%s失败：%s', url, e)
         except Exception as e:
-            error_file = self.get_filepath(
-                type) + os.sep + 'not_downloaded.txt'
-            with open(error_file, 'ab') as f:
-                url = str(weibo_id) + ':' + file_path + ':' + url + '\n'
-                f.write(url.encode(sys.stdout.encoding))
+            download_queue.push(url, file_path, type, weibo_id, e)
             logger.exception(e)
 
+    def retry_downloads(self):
+        """重新下载队列中已到重试时间的文件"""
+        download_list = self.get_download_queue().due()
+        if not download_list:
+            return
+        from tqdm import tqdm
+
+        logger.info(u'即将重新下载%d个之前下载失败的文件', len(download_list))
+        with ThreadPoolExecutor(self.download_workers) as executor:
+            futures = [
+                executor.submit(self.download_one_file, url, file_path, type,
+                                weibo_id)
+                for url, file_path, type, weibo_id in download_list
+            ]
+            for future in tqdm(as_completed(futures),
+                               total=len(futures),
+                               desc='Retry progress'):
+                future.result()
+
     def handle_download(self, file_type, file_dir, urls, w):
-        """处理下载相关操作"""
+        """获取一条微博中要下载的文件，返回(url, 文件路径)列表"""
         file_prefix = w['created_at'][:11].replace('-', '') + '_' + str(
             w['id'])
+        download_list = []
         if file_type == 'img':
             if ',' in urls:
                 url_list = urls.split(',')
@@ -400,7 +1253,7 @@ class Weibo(object):
                         file_suffix = url[index:]
                     file_name = file_prefix + '_' + str(i + 1) + file_suffix
                     file_path = file_dir + os.sep + file_name
-                    self.download_one_file(url, file_path, file_type, w['id'])
+                    download_list.append((url, file_path))
             else:
                 index = urls.rfind('.')
                 if len(urls) - index > 5:
@@ -409,7 +1262,7 @@ class Weibo(object):
                     file_suffix = urls[index:]
                 file_name = file_prefix + file_suffix
                 file_path = file_dir + os.sep + file_name
-                self.download_one_file(urls, file_path, file_type, w['id'])
+                download_list.append((urls, file_path))
         else:
             file_suffix = '.mp4'
             if ';' in urls:
@@ -419,16 +1272,19 @@ class Weibo(object):
                 for i, url in enumerate(url_list):
                     file_name = file_prefix + '_' + str(i + 1) + file_suffix
                     file_path = file_dir + os.sep + file_name
-                    self.download_one_file(url, file_path, file_type, w['id'])
+                    download_list.append((url, file_path))
             else:
                 if urls.endswith('.mov'):
                     file_suffix = '.mov'
                 file_name = file_prefix + file_suffix
                 file_path = file_dir + os.sep + file_name
-                self.download_one_file(urls, file_path, file_type, w['id'])
+                download_list.append((urls, file_path))
+        return download_list
 
     def download_files(self, file_type, weibo_type, wrote_count):
         """下载文件(图片/视频)"""
+        from tqdm import tqdm
+
         try:
             describe = ''
             if file_type == 'img':
@@ -446,14 +1302,25 @@ class Weibo(object):
             file_dir = file_dir + os.sep + describe
             if not os.path.isdir(file_dir):
                 os.makedirs(file_dir)
-            for w in tqdm(self.weibo[wrote_count:], desc='Download progress'):
-                if weibo_type == 'retweet':
-                    if w.get('retweet'):
-                        w = w['retweet']
-                    else:
-                        continue
-                if w.get(key):
-                    self.handle_download(file_type, file_dir, w.get(key), w)
+            with ThreadPoolExecutor(self.download_workers) as executor:
+                futures = []
+                for w in self.weibo[wrote_count:]:
+                    if weibo_type == 'retweet':
+                        if w.get('retweet'):
+                            w = w['retweet']
+                        else:
+                            continue
+                    if w.get(key):
+                        for url, file_path in self.handle_download(
+                                file_type, file_dir, w.get(key), w):
+                            futures.append(
+                                executor.submit(self.download_one_file, url,
+                                                file_path, file_type,
+                                                w['id']))
+                for future in tqdm(as_completed(futures),
+                                   total=len(futures),
+                                   desc='Download progress'):
+                    future.result()
             logger.info(u'%s下载完毕,保存路径:', describe)
             logger.info(file_dir)
         except Exception as e:
@@ -584,12 +1451,15 @@ class Weibo(object):
             weibo['screen_name'] = ''
         weibo['id'] = int(weibo_info['id'])
         weibo['bid'] = weibo_info['bid']
+        from lxml import etree
+
         text_body = weibo_info['text']
         selector = etree.HTML(text_body)
         # Use separate selector.
         weibo['article_url'] = self.get_article_url(selector)
         weibo['pics'] = self.get_pics(weibo_info)
         weibo['video_url'] = self.get_video_url(weibo_info)
+        weibo['video_variants'] = self.get_video_variants(weibo_info)
         weibo['text'] = self.get_text_body(
             selector, weibo['pics'] + weibo['video_url'])
         weibo['location'] = self.get_location(selector)
@@ -606,56 +1476,76 @@ class Weibo(object):
         return self.standardize_info(weibo)
 
     def print_user_info(self):
-        """打印用户信息"""
-        logger.info('+' * 100)
-        logger.info(u'用户信息')
-        logger.info(u'用户id：%s', self.user['id'])
-        logger.info(u'用户昵称：%s', self.user['screen_name'])
+        """打印用户信息，INFO级别只输出一行json，各项详情在DEBUG级别输出"""
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(u'用户信息：%s', json_dumps({
+                'id': self.user['id'],
+                'screen_name': self.user['screen_name'],
+                'statuses_count': self.user['statuses_count'],
+                'followers_count': self.user['followers_count'],
+            }).decode('utf-8'))
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        logger.debug(u'用户id：%s', self.user['id'])
+        logger.debug(u'用户昵称：%s', self.user['screen_name'])
         gender = u'女' if self.user['gender'] == 'f' else u'男'
-        logger.info(u'性别：%s', gender)
-        logger.info(u'生日：%s', self.user['birthday'])
-        logger.info(u'所在地：%s', self.user['location'])
-        logger.info(u'教育经历：%s', self.user['education'])
-        logger.info(u'公司：%s', self.user['company'])
-        logger.info(u'阳光信用：%s', self.user['sunshine'])
-        logger.info(u'注册时间：%s', self.user['registration_time'])
-        logger.info(u'微博数：%d', self.user['statuses_count'])
-        logger.info(u'粉丝数：%d', self.user['followers_count'])
-        logger.info(u'关注数：%d', self.user['follow_count'])
-        logger.info(u'url：https://m.weibo.cn/profile/%s', self.user['id'])
+        logger.debug(u'性别：%s', gender)
+        logger.debug(u'生日：%s', self.user['birthday'])
+        logger.debug(u'所在地：%s', self.user['location'])
+        logger.debug(u'教育经历：%s', self.user['education'])
+        logger.debug(u'公司：%s', self.user['company'])
+        logger.debug(u'阳光信用：%s', self.user['sunshine'])
+        logger.debug(u'注册时间：%s', self.user['registration_time'])
+        logger.debug(u'微博数：%d', self.user['statuses_count'])
+        logger.debug(u'粉丝数：%d', self.user['followers_count'])
+        logger.debug(u'关注数：%d', self.user['follow_count'])
+        logger.debug(u'url：https://m.weibo.cn/profile/%s', self.user['id'])
         if self.user.get('verified_reason'):
-            logger.info(self.user['verified_reason'])
-        logger.info(self.user['description'])
-        logger.info('+' * 100)
+            logger.debug(self.user['verified_reason'])
+        logger.debug(self.user['description'])
 
     def print_one_weibo(self, weibo):
-        """打印一条微博"""
+        """在DEBUG级别逐项打印一条微博"""
         try:
-            logger.info(u'微博id：%d', weibo['id'])
-            logger.info(u'微博正文：%s', weibo['text'])
-            logger.info(u'原始图片url：%s', weibo['pics'])
-            logger.info(u'微博位置：%s', weibo['location'])
-            logger.info(u'发布时间：%s', weibo['created_at'])
-            logger.info(u'发布工具：%s', weibo['source'])
-            logger.info(u'点赞数：%d', weibo['attitudes_count'])
-            logger.info(u'评论数：%d', weibo['comments_count'])
-            logger.info(u'转发数：%d', weibo['reposts_count'])
-            logger.info(u'话题：%s', weibo['topics'])
-            logger.info(u'@用户：%s', weibo['at_users'])
-            logger.info(u'url：https://m.weibo.cn/detail/%d', weibo['id'])
+            logger.debug(u'微博id：%d', weibo['id'])
+            logger.debug(u'微博正文：%s', weibo['text'])
+            logger.debug(u'原始图片url：%s', weibo['pics'])
+            logger.debug(u'微博位置：%s', weibo['location'])
+            logger.debug(u'发布时间：%s', weibo['created_at'])
+            logger.debug(u'发布工具：%s', weibo['source'])
+            logger.debug(u'点赞数：%d', weibo['attitudes_count'])
+            logger.debug(u'评论数：%d', weibo['comments_count'])
+            logger.debug(u'转发数：%d', weibo['reposts_count'])
+            logger.debug(u'话题：%s', weibo['topics'])
+            logger.debug(u'@用户：%s', weibo['at_users'])
+            logger.debug(u'url：https://m.weibo.cn/detail/%d', weibo['id'])
         except OSError:
             pass
 
     def print_weibo(self, weibo):
-        """打印微博，若为转发微博，会同时打印原创和转发部分"""
+        """打印微博
+
+        INFO级别每条微博只输出一行json，不含正文；DEBUG级别逐项打印，
+        若为转发微博，会同时打印原创和转发部分
+        """
+        if logger.isEnabledFor(logging.INFO):
+            record = {
+                'id': weibo['id'],
+                'user_id': weibo['user_id'],
+                'created_at': weibo['created_at'],
+                'pics': len(weibo['pics'].split(',')) if weibo['pics'] else 0,
+                'video': bool(weibo['video_url']),
+            }
+            if weibo.get('retweet'):
+                record['retweet_id'] = weibo['retweet']['id']
+            logger.info(u'微博：%s', json_dumps(record).decode('utf-8'))
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
         if weibo.get('retweet'):
-            logger.info('*' * 100)
-            logger.info(u'转发部分：')
+            logger.debug(u'转发部分：')
             self.print_one_weibo(weibo['retweet'])
-            logger.info('*' * 100)
-            logger.info(u'原创部分：')
+            logger.debug(u'原创部分：')
         self.print_one_weibo(weibo)
-        logger.info('-' * 120)
 
     def get_one_weibo(self, info):
         """获取一条微博的全部信息"""
@@ -705,20 +1595,56 @@ class Weibo(object):
         else:
             return False
 
-    def get_one_page(self, page):
-        """获取一页的全部微博"""
+    def claim_weibo_id(self, weibo_id):
+        """把微博id加入已爬取集合，若该id已被爬取过则返回False"""
+        weibo_id = int(weibo_id)
+        with self.crawl_lock:
+            if weibo_id in self.weibo_id_list:
+                return False
+            self.weibo_id_list.add(weibo_id)
+            return True
+
+    def get_page_fingerprint(self, js):
+        """根据一页微博的id和编辑标记计算指纹，页面没有变化时指纹不变"""
+        if not js.get('ok'):
+            return None
+        weibos = js['data']['cards']
+        if self.query:
+            weibos = weibos[0]['card_group']
+        marks = []
+        for w in weibos:
+            if w.get('card_type') == 9:
+                mblog = w['mblog']
+                marks.append('%s:%s:%s' % (mblog['id'], mblog.get(
+                    'edit_count', 0), mblog.get('edit_at', '')))
+        return hashlib.md5(','.join(marks).encode('utf-8')).hexdigest()
+
+    def get_one_page(self, page, js=None):
+        """获取一页的全部微博，js为已获取的该页json数据"""
+        posts = self.iter_one_page(page, js)
+        while True:
+            try:
+                wb = next(posts)
+            except StopIteration as stop:
+                return stop.value
+            self.weibo.append(wb)
+
+    def iter_one_page(self, page, js=None):
+        """逐条生成一页中的微博，返回True代表已没有更多微博"""
         try:
-            js = self.get_weibo_json(page)
+            if js is None:
+                js = self.get_weibo_json(page)
             if js['ok']:
                 weibos = js['data']['cards']
                 if self.query:
                     weibos = weibos[0]['card_group']
                 for w in weibos:
                     if w['card_type'] == 9:
+                        # 先按id去重，避免重复获取其它关键词已爬到的微博
+                        if not self.claim_weibo_id(w['mblog']['id']):
+                            continue
                         wb = self.get_one_weibo(w)
                         if wb:
-                            if wb['id'] in self.weibo_id_list:
-                                continue
                             created_at = datetime.strptime(
                                 wb['created_at'], '%Y-%m-%d')
                             since_date = datetime.strptime(
@@ -738,18 +1664,20 @@ class Weibo(object):
                             if (not self.is_pinned_weibo(w)) \
                                and ((not self.filter)
                                     or ('retweet' not in wb.keys())):
-                                self.weibo.append(wb)
-                                self.weibo_id_list.append(wb['id'])
                                 self.got_count += 1
                                 self.print_weibo(wb)
+                                yield wb
                             else:
                                 logger.info(u'正在过滤转发微博')
+                        else:
+                            self.failed_count += 1
             else:
                 return True
             logger.info(u'{}已获取{}({})的第{}页微博{}'.format(
                 '-' * 30, self.user['screen_name'], self.user['id'], page,
                 '-' * 30))
         except Exception as e:
+            self.failed_count += 1
             logger.exception(e)
 
     def get_page_count(self):
@@ -777,7 +1705,9 @@ class Weibo(object):
         for w in self.weibo[wrote_count:]:
             wb = OrderedDict()
             for k, v in w.items():
-                if k not in ['user_id', 'screen_name', 'retweet']:
+                if k not in [
+                        'user_id', 'screen_name', 'retweet', 'video_variants'
+                ]:
                     if 'unicode' in str(type(v)):
                         v = v.encode('utf-8')
                     wb[k] = v
@@ -785,6 +1715,8 @@ class Weibo(object):
                 if w.get('retweet'):
                     wb['is_original'] = False
                     for k2, v2 in w['retweet'].items():
+                        if k2 == 'video_variants':
+                            continue
                         if 'unicode' in str(type(v2)):
                             v2 = v2.encode('utf-8')
                         wb['retweet_' + k2] = v2
@@ -833,25 +1765,9 @@ class Weibo(object):
         file_path = self.get_filepath('csv')
         self.csv_helper(result_headers, result_data, file_path)
 
-    def csv_helper(self, headers, result_data, file_path):
+    def csv_helper(self, headers, result_data, file_path, unique=False):
         """将指定信息写入csv文件"""
-        if not os.path.isfile(file_path):
-            is_first_write = 1
-        else:
-            is_first_write = 0
-        if sys.version < '3':  # python2.x
-            with open(file_path, 'ab') as f:
-                f.write(codecs.BOM_UTF8)
-                writer = csv.writer(f)
-                if is_first_write:
-                    writer.writerows([headers])
-                writer.writerows(result_data)
-        else:  # python3.x
-            with open(file_path, 'a', encoding='utf-8-sig', newline='') as f:
-                writer = csv.writer(f)
-                if is_first_write:
-                    writer.writerows([headers])
-                writer.writerows(result_data)
+        csv_writer.writerows(file_path, headers, result_data, unique)
         if headers[0] == 'id':
             logger.info(u'%d条微博写入csv文件完毕,保存路径:', self.got_count)
         else:
@@ -888,15 +1804,127 @@ class Weibo(object):
         data = {}
         path = self.get_filepath('json')
         if os.path.isfile(path):
-            with codecs.open(path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            with open(path, 'rb') as f:
+                data = json_loads(f.read())
         weibo_info = self.weibo[wrote_count:]
         data = self.update_json_data(data, weibo_info)
-        with codecs.open(path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False)
+        with open(path, 'wb') as f:
+            f.write(json_dumps(data))
         logger.info(u'%d条微博写入json文件完毕,保存路径:', self.got_count)
         logger.info(path)
 
+    def rebuild_jsonl_index(self, path):
+        """扫描jsonl结果文件，重建id索引文件
+
+        上次写入中断留下的不完整的最后一行会被截掉，无法解析的行会被跳过
+        """
+        index = {}
+        line_count = 0
+        with open(path, 'rb+') as f:
+            offset = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    logger.warning(u'%s最后一行不完整，已截掉', path)
+                    f.truncate(offset)
+                    break
+                if line.strip():
+                    try:
+                        weibo_id = str(json_loads(line)['id'])
+                    except (ValueError, KeyError, TypeError):
+                        logger.warning(u'%s第%d字节处的记录无法解析，已跳过',
+                                       path, offset)
+                    else:
+                        index[weibo_id] = offset
+                        line_count += 1
+                offset += len(line)
+        with open(path + '.idx', 'w') as f:
+            f.writelines('%s %d\n' % (weibo_id, offset)
+                         for weibo_id, offset in index.items())
+        self.jsonl_stale[path] = line_count - len(index)
+        return index
+
+    def load_jsonl_index(self, path):
+        """获取jsonl结果文件的id索引，索引文件缺失或与结果文件不一致时重建"""
+        if path in self.jsonl_index:
+            return self.jsonl_index[path]
+        index = {}
+        line_count = 0
+        size = os.path.getsize(path) if os.path.isfile(path) else 0
+        index_path = path + '.idx'
+        is_valid = os.path.isfile(index_path) or size == 0
+        if os.path.isfile(index_path):
+            with open(index_path, 'r') as f:
+                for line in f:
+                    info = line.split()
+                    if len(info) != 2 or int(info[1]) >= size:
+                        is_valid = False
+                        break
+                    index[info[0]] = int(info[1])
+                    line_count += 1
+        if is_valid and size:
+            # 索引最后一条记录必须正好是结果文件的最后一行，否则说明上次写入中断
+            with open(path, 'rb') as f:
+                f.seek(max(index.values(), default=size))
+                f.readline()
+                is_valid = bool(index) and f.tell() == size
+        if is_valid:
+            self.jsonl_stale[path] = line_count - len(index)
+        else:
+            logger.info(u'正在重建%s的索引', path)
+            index = self.rebuild_jsonl_index(path) if size else {}
+        self.jsonl_index[path] = index
+        return index
+
+    def write_jsonl(self, wrote_count):
+        """将爬到的信息追加写入jsonl文件，id相同的记录以最后写入的为准"""
+        path = self.get_filepath('jsonl')
+        index = self.load_jsonl_index(path)
+        index_lines = []
+        with open(path, 'ab') as f:
+            offset = f.tell()
+            for w in self.weibo[wrote_count:]:
+                line = json_dumps(w) + b'\n'
+                f.write(line)
+                weibo_id = str(w['id'])
+                if weibo_id in index:
+                    self.jsonl_stale[path] = self.jsonl_stale.get(path, 0) + 1
+                index[weibo_id] = offset
+                index_lines.append('%s %d\n' % (weibo_id, offset))
+                offset += len(line)
+        with open(path + '.idx', 'a') as f:
+            f.writelines(index_lines)
+        logger.info(u'%d条微博写入jsonl文件完毕,保存路径:', self.got_count)
+        logger.info(path)
+
+    def compact_jsonl(self, path):
+        """压缩jsonl结果文件，只保留每条微博最新的记录"""
+        index = self.load_jsonl_index(path)
+        new_index = {}
+        with open(path, 'rb') as src, open(path + '.tmp', 'wb') as dst:
+            for weibo_id, offset in sorted(index.items(), key=lambda x: x[1]):
+                src.seek(offset)
+                new_index[weibo_id] = dst.tell()
+                dst.write(src.readline())
+        with open(path + '.idx.tmp', 'w') as f:
+            f.writelines('%s %d\n' % (weibo_id, offset)
+                         for weibo_id, offset in new_index.items())
+        # 先删除旧索引，这样即使中途退出，下次运行也会重建索引而不是读到错误的偏移量
+        os.remove(path + '.idx')
+        os.replace(path + '.tmp', path)
+        os.replace(path + '.idx.tmp', path + '.idx')
+        self.jsonl_index[path] = new_index
+        self.jsonl_stale[path] = 0
+        logger.info(u'%s压缩完毕', path)
+
+    def maybe_compact_jsonl(self):
+        """过期记录数超过有效记录数时压缩jsonl结果文件"""
+        path = self.get_filepath('jsonl')
+        if not os.path.isfile(path):
+            return
+        index = self.load_jsonl_index(path)
+        if self.jsonl_stale.get(path, 0) > len(index):
+            self.compact_jsonl(path)
+
     def info_to_mongodb(self, collection, info_list):
         """将爬取的信息写入MongoDB数据库"""
         try:
@@ -906,20 +1934,7 @@ class Weibo(object):
                 u'系统中可能没有安装pymongo库，请先运行 pip install pymongo ，再运行程序')
             sys.exit()
         try:
-            from pymongo import MongoClient
-
-            client = MongoClient()
-            db = client['weibo']
-            collection = db[collection]
-            if len(self.write_mode) > 1:
-                new_info_list = copy.deepcopy(info_list)
-            else:
-                new_info_list = info_list
-            for info in new_info_list:
-                if not collection.find_one({'id': info['id']}):
-                    collection.insert_one(info)
-                else:
-                    collection.update_one({'id': info['id']}, {'$set': info})
+            mongo_writer.upsert(collection, info_list)
         except pymongo.errors.ServerSelectionTimeoutError:
             logger.warning(
                 u'系统中可能没有安装或启动MongoDB数据库，请先根据系统环境安装或启动MongoDB，再运行程序')
@@ -946,55 +1961,51 @@ class Weibo(object):
             logger.warning(
                 u'系统中可能没有安装pymysql库，请先运行 pip install pymysql ，再运行程序')
             sys.exit()
+        if sql in mysql_writer.executed_sql:
+            return
         try:
             if self.mysql_config:
                 mysql_config = self.mysql_config
             connection = pymysql.connect(**mysql_config)
             self.mysql_create(connection, sql)
+            mysql_writer.executed_sql.add(sql)
         except pymysql.OperationalError:
             logger.warning(u'系统中可能没有安装或正确配置MySQL数据库，请先根据系统环境安装或配置MySQL，再运行程序')
             sys.exit()
 
-    def mysql_create_table(self, mysql_config, sql):
-        """创建MySQL表"""
-        import pymysql
-
+    def get_mysql_config(self, mysql_config):
+        """获取连接'weibo'数据库所用的配置"""
         if self.mysql_config:
             mysql_config = self.mysql_config
-        mysql_config['db'] = 'weibo'
-        connection = pymysql.connect(**mysql_config)
-        self.mysql_create(connection, sql)
+        return dict(mysql_config, db='weibo')
+
+    def mysql_create_table(self, mysql_config, sql):
+        """创建MySQL表"""
+        mysql_writer.execute_once(self.get_mysql_config(mysql_config), sql)
 
     def mysql_insert(self, mysql_config, table, data_list):
         """向MySQL表插入或更新数据"""
-        import pymysql
-
         if len(data_list) > 0:
-            keys = ', '.join(data_list[0].keys())
-            values = ', '.join(['%s'] * len(data_list[0]))
-            if self.mysql_config:
-                mysql_config = self.mysql_config
-            mysql_config['db'] = 'weibo'
-            connection = pymysql.connect(**mysql_config)
-            cursor = connection.cursor()
-            sql = """INSERT INTO {table}({keys}) VALUES ({values}) ON
-                     DUPLICATE KEY UPDATE""".format(table=table,
-                                                    keys=keys,
-                                                    values=values)
-            update = ','.join([
-                ' {key} = values({key})'.format(key=key)
-                for key in data_list[0]
-            ])
-            sql += update
-            try:
-                cursor.executemany(
-                    sql, [tuple(data.values()) for data in data_list])
-                connection.commit()
-            except Exception as e:
-                connection.rollback()
-                logger.exception(e)
-            finally:
-                connection.close()
+            mysql_writer.insert(self.get_mysql_config(mysql_config), table,
+                                data_list, self.mysql_chunk_size)
+
+    def get_flat_weibo_list(self, wrote_count):
+        """将转发微博的原微博拆成单独的记录，用retweet_id关联，原微博排在前面"""
+        weibo_list = []
+        retweet_list = []
+        for w in self.weibo[wrote_count:]:
+            w = OrderedDict(w)
+            w.pop('video_variants', None)
+            if 'retweet' in w:
+                retweet = OrderedDict(w.pop('retweet'))
+                retweet.pop('video_variants', None)
+                retweet['retweet_id'] = ''
+                retweet_list.append(retweet)
+                w['retweet_id'] = retweet['id']
+            else:
+                w['retweet_id'] = ''
+            weibo_list.append(w)
+        return retweet_list + weibo_list
 
     def weibo_to_mysql(self, wrote_count):
         """将爬取的微博信息写入MySQL数据库"""
@@ -1028,26 +2039,23 @@ class Weibo(object):
                 PRIMARY KEY (id)
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4"""
         self.mysql_create_table(mysql_config, create_table)
-        weibo_list = []
-        retweet_list = []
-        if len(self.write_mode) > 1:
-            info_list = copy.deepcopy(self.weibo[wrote_count:])
-        else:
-            info_list = self.weibo[wrote_count:]
-        for w in info_list:
-            if 'retweet' in w:
-                w['retweet']['retweet_id'] = ''
-                retweet_list.append(w['retweet'])
-                w['retweet_id'] = w['retweet']['id']
-                del w['retweet']
-            else:
-                w['retweet_id'] = ''
-            weibo_list.append(w)
-        # 在'weibo'表中插入或更新微博数据
-        self.mysql_insert(mysql_config, 'weibo', retweet_list)
-        self.mysql_insert(mysql_config, 'weibo', weibo_list)
+        # 在'weibo'表中插入或更新微博数据，原微博和转发微博在同一个事务中写入
+        self.mysql_insert(mysql_config, 'weibo',
+                          self.get_flat_weibo_list(wrote_count))
         logger.info(u'%d条微博写入MySQL数据库完毕', self.got_count)
 
+    def weibo_to_sqlite(self, wrote_count):
+        """将爬取的微博信息写入SQLite数据库"""
+        sqlite_writer.upsert(self.get_sqlite_path(), 'weibo',
+                             SqliteWriter.weibo_columns,
+                             self.get_flat_weibo_list(wrote_count))
+        logger.info(u'%d条微博写入SQLite数据库完毕', self.got_count)
+
+    def weibo_to_search_index(self, wrote_count):
+        """将爬取的微博写入全文索引"""
+        sqlite_writer.index(self.get_sqlite_path(),
+                            self.get_flat_weibo_list(wrote_count))
+
     def update_user_config_file(self, user_config_file_path):
         """更新用户配置文件"""
         with open(user_config_file_path, 'rb') as f:
@@ -1076,15 +2084,26 @@ class Weibo(object):
 
     def write_data(self, wrote_count):
         """将爬到的信息写入文件或数据库"""
-        if self.got_count > wrote_count:
+        with self.write_lock:
+            self.write_new_data(wrote_count)
+
+    def write_new_data(self, wrote_count):
+        """将第wrote_count条之后的微博写入文件或数据库"""
+        if len(self.weibo) > wrote_count:
             if 'csv' in self.write_mode:
                 self.write_csv(wrote_count)
             if 'json' in self.write_mode:
                 self.write_json(wrote_count)
+            if 'jsonl' in self.write_mode:
+                self.write_jsonl(wrote_count)
             if 'mysql' in self.write_mode:
                 self.weibo_to_mysql(wrote_count)
             if 'mongo' in self.write_mode:
                 self.weibo_to_mongodb(wrote_count)
+            if 'sqlite' in self.write_mode:
+                self.weibo_to_sqlite(wrote_count)
+            if self.search_index:
+                self.weibo_to_search_index(wrote_count)
             if self.original_pic_download:
                 self.download_files('img', 'original', wrote_count)
             if self.original_video_download:
@@ -1095,40 +2114,44 @@ class Weibo(object):
                 if self.retweet_video_download:
                     self.download_files('video', 'retweet', wrote_count)
 
-    def get_pages(self):
-        """获取全部微博"""
-        try:
-            self.get_user_info()
-            self.print_user_info()
-            since_date = datetime.strptime(self.user_config['since_date'],
-                                           '%Y-%m-%d')
-            today = datetime.strptime(str(date.today()), '%Y-%m-%d')
-            if since_date <= today:
-                page_count = self.get_page_count()
-                wrote_count = 0
-                page1 = 0
-                random_pages = random.randint(1, 5)
-                self.start_date = datetime.now().strftime('%Y-%m-%d')
-                pages = range(self.start_page, page_count + 1)
-                for page in tqdm(pages, desc='Progress'):
-                    is_end = self.get_one_page(page)
-                    if is_end:
-                        break
+    def iter_posts(self, user_config=None):
+        """边爬取边逐条生成用户的微博，不在内存中保留已生成的微博
 
-                    if page % 20 == 0:  # 每爬20页写入一次文件
-                        self.write_data(wrote_count)
-                        wrote_count = self.got_count
+        user_config为None时使用当前的用户配置和已获取的用户信息
+        """
+        from tqdm import tqdm
 
-                    # 通过加入随机等待避免被限制。爬虫速度过快容易被系统限制(一段时间后限
-                    # 制会自动解除)，加入随机等待模拟人的操作，可降低被系统限制的风险。默
-                    # 认是每爬取1到5页随机等待6到10秒，如果仍然被限，可适当增加sleep时间
-                    if (page -
-                            page1) % random_pages == 0 and page < page_count:
-                        sleep(random.randint(6, 10))
-                        page1 = page
-                        random_pages = random.randint(1, 5)
+        if user_config is not None:
+            self.initialize_info(user_config)
+        if not self.user:
+            self.get_user_info()
+            self.print_user_info()
+        since_date = datetime.strptime(self.user_config['since_date'],
+                                       '%Y-%m-%d')
+        today = datetime.strptime(str(date.today()), '%Y-%m-%d')
+        if since_date > today:
+            return
+        page_count = self.get_page_count()
+        self.start_date = datetime.now().strftime('%Y-%m-%d')
+        pages = range(self.start_page, page_count + 1)
+        for page in tqdm(pages, desc='Progress'):
+            is_end = yield from self.iter_one_page(page)
+            if is_end:
+                break
 
-                self.write_data(wrote_count)  # 将剩余不足20页的微博写入文件
+    def get_pages(self):
+        """获取全部微博"""
+        try:
+            for wb in self.iter_posts():
+                self.weibo.append(wb)
+                if len(self.weibo) >= 200:  # 每爬200条微博写入一次文件
+                    self.write_data(0)
+                    self.weibo = []
+            self.write_data(0)  # 将剩余不足200条的微博写入文件
+            self.weibo = []
+            if 'jsonl' in self.write_mode and self.jsonl_compact:
+                with self.write_lock:
+                    self.maybe_compact_jsonl()
             logger.info(u'微博爬取完成，共爬取%d条微博', self.got_count)
         except Exception as e:
             logger.exception(e)
@@ -1170,17 +2193,41 @@ class Weibo(object):
         self.user = {}
         self.user_config = user_config
         self.got_count = 0
-        self.weibo_id_list = []
+        self.failed_count = 0
+        self.weibo_id_list = set()
+
+    def get_query_pages(self, query):
+        """在单独的线程中获取包含关键词query的全部微博，返回该线程的爬虫"""
+        worker = copy.copy(self)  # 共用用户信息、去重集合、锁和请求限制
+        worker.query = query
+        worker.weibo = []
+        worker.got_count = 0
+        worker.failed_count = 0
+        worker.get_pages()
+        return worker
+
+    def get_all_query_pages(self, user_config):
+        """同时爬取用户所有关键词的微博，用户信息只获取一次"""
+        self.initialize_info(user_config)
+        self.get_user_info()
+        if not self.user:
+            return
+        self.print_user_info()
+        query_list = user_config['query_list']
+        with ThreadPoolExecutor(max_workers=max(
+                1, min(self.query_workers, len(query_list)))) as executor:
+            workers = list(executor.map(self.get_query_pages, query_list))
+        for worker in workers:
+            self.got_count += worker.got_count
+            self.start_date = worker.start_date or self.start_date
 
     def start(self):
         """运行爬虫"""
         try:
             for user_config in self.user_config_list:
                 if len(user_config['query_list']):
-                    for query in user_config['query_list']:
-                        self.query = query
-                        self.initialize_info(user_config)
-                        self.get_pages()
+                    self.get_all_query_pages(user_config)
+                    self.query = ''
                 else:
                     self.initialize_info(user_config)
                     self.get_pages()
@@ -1188,8 +2235,12 @@ class Weibo(object):
                 logger.info('*' * 100)
                 if self.user_config_file_path and self.user:
                     self.update_user_config_file(self.user_config_file_path)
+            self.retry_downloads()
         except Exception as e:
             logger.exception(e)
+        finally:
+            csv_writer.flush()
+            self.request_governor.save()
 
 
 def get_config():
@@ -1202,7 +2253,7 @@ def get_config():
         sys.exit()
     try:
         with open(config_path, encoding='utf-8') as f:
-            config = json.loads(f.read())
+            config = json_loads(f.read())
             return config
     except ValueError:
         logger.error(u'config.json 格式不正确，请参考 '
@@ -1210,8 +2261,37 @@ def get_config():
         sys.exit()
 
 
+def search(argv):
+    """在全文索引中搜索微博并打印结果"""
+    parser = argparse.ArgumentParser(prog='weibo.py search',
+                                     description=u'在全文索引中搜索微博')
+    parser.add_argument(
+        'query',
+        help=u'关键词，含空格或标点且少于3个字的关键词不走索引，速度较慢')
+    parser.add_argument('--user', help=u'只搜索该user_id的微博')
+    parser.add_argument('--since', help=u'只搜索该日期(yyyy-mm-dd)及以后的微博')
+    parser.add_argument('--until', help=u'只搜索该日期(yyyy-mm-dd)及以前的微博')
+    parser.add_argument('--limit', type=int, default=20, help=u'最多显示的条数')
+    args = parser.parse_args(argv)
+    config = get_config()
+    path = os.path.join(
+        os.path.split(os.path.realpath(__file__))[0], 'weibo',
+        config.get('sqlite_path') or 'weibo.sqlite3')
+    if not os.path.isfile(path):
+        sys.exit(u'不存在%s文件，请先设置search_index并爬取微博' % path)
+    for weibo_id, screen_name, created_at, text in search_weibo(
+            path, args.query, args.user, args.since, args.until, args.limit):
+        print(u'{} {} https://m.weibo.cn/detail/{}'.format(
+            created_at, screen_name, weibo_id))
+        print(text.replace('\n', ' ')[:140])
+        print('')
+
+
 def main():
     try:
+        if sys.argv[1:2] == ['search']:
+            search(sys.argv[2:])
+            return
         config = get_config()
         wb = Weibo(config)
         wb.start()  # 爬取微博信息
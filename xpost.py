@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import argparse
+import hashlib
 import json
 import os
 from datetime import datetime
@@ -11,40 +13,115 @@ import re
 import unicodedata
 import sqlite3
 import atexit
+import io
+import subprocess
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from mastodon import Mastodon, MastodonError, MastodonAPIError, MastodonNotFoundError
-import requests
-
-import weibo
 
 DATABASE_FILE = 'posted.sqlite3'
 TOKEN_FILE = 'token.json'
 CONFIG_FILE = 'config.json'
+TRANSCODE_DIR = 'transcode_cache'
+# Oldest transcoded videos are removed when the cache grows past this.
+TRANSCODE_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+POST_INDEX_SIZE = 10000
+INSTANCE_LIMITS_TTL = 24 * 60 * 60
+# A weibo user that fails is skipped for this long, doubling with each
+# consecutive failure, up to USER_BACKOFF_MAX.
+USER_BACKOFF_BASE = 10 * 60
+USER_BACKOFF_MAX = 24 * 60 * 60
+# Mastodon counts every URL as this many characters by default.
+URL_LENGTH = 23
+# Mastodon only links the ASCII characters allowed in URLs, so a URL
+# stops where CJK text glued to it begins. Trailing punctuation isn’t
+# part of the URL.
+URL_PATTERN = re.compile(
+    r'https?://[A-Za-z0-9.-]*[A-Za-z0-9](?::[0-9]+)?'
+    r"(?:[/?#][A-Za-z0-9!#$%&'()*+,./:;=?@\[\]_~|-]*[A-Za-z0-9/=&#%~+_-])?")
 
 ### Types
 #
-# POST_RECORD := [int(toot_id), int(weibo_id), int(user_id), str(user_name), str(post summary), str(post time)]
+# POST_RECORD := [int(toot_id), int(weibo_id), int(user_id), str(user_name), str(post summary), str(post time), int(fail_count), str(target), str(content_hash)]
 # TOOT_DICT := (Refer https://mastodonpy.readthedocs.io/en/stable/#toot-dicts)
 # CONFIG := {
 #             'user_list': USER_CONFIG,
 #             'mastodon_instance_url': str,
-#             'toot_len_limit': int,
-#             'max_attachment_count': int
+#             'toot_len_limit': int, (optional)
+#             'max_attachment_count': int, (optional)
 #             'include_repost': bool,
 #             'external_media': bool, (optional)
 #             'standalone_repost': bool,
-#             'include_post_url': bool
+#             'include_post_url': bool,
+#             'sync_edits': bool, (optional)
+#             'recompress_images': bool, (optional)
+#             'image_size_limit': int, (optional)
+#             'image_quality': int, (optional)
+#             'png_size_limit': int, (optional)
+#             'video_size_limit': int, (optional)
+#             'transcode_videos': bool, (optional)
+#             'video_duration_limit': int, (optional)
+#             'ffmpeg_path': str, (optional)
+#             'ffprobe_path': str, (optional)
+#             'transcode_workers': int, (optional)
+#             'transcode_threads': int, (optional)
+#             'transcode_cache_size': int (optional)
 #           }
 # USER_CONFIG := {
 #                  'id': string,
 #                  'include_repost': bool, (optional)
 #                  'external_media': bool, (optional)
-#                  'standalone_repost': bool  (optional)
+#                  'standalone_repost': bool, (optional)
+#                  'sync_edits': bool, (optional)
+#                  'recompress_images': bool, (optional)
+#                  'image_size_limit': int, (optional)
+#                  'image_quality': int, (optional)
+#                  'png_size_limit': int, (optional)
+#                  'video_size_limit': int, (optional)
+#                  'transcode_videos': bool, (optional)
+#                  'video_duration_limit': int (optional)
 #                 }
+# MEDIA_CONFIG := {
+#                   'recompress_images': bool,
+#                   'image_size_limit': int,
+#                   'image_quality': int,
+#                   'png_size_limit': int,
+#                   'video_size_limit': int,
+#                   'transcode_videos': bool,
+#                   'video_duration_limit': int or None,
+#                   'image_matrix_limit': int or None,
+#                   'video_matrix_limit': int or None,
+#                   'ffmpeg_path': str,
+#                   'ffprobe_path': str,
+#                   'transcode_workers': int,
+#                   'transcode_threads': int,
+#                   'transcode_cache_size': int
+#                  }
+# INDEX_ENTRY := (str(toot_id) or None, int(fail_count))
+# INDEX_KEY := (str(target), str(weibo_id))
+# USER_HEALTH := (str(user_id), int(fail_count), str(last_error),
+#                 float(failed_at), float(retry_at))
+# INSTANCE_LIMITS := {
+#                      'max_characters': int,
+#                      'max_media_attachments': int,
+#                      'characters_reserved_per_url': int,
+#                      'image_size_limit': int,
+#                      'image_matrix_limit': int,
+#                      'video_size_limit': int,
+#                      'video_matrix_limit': int
+#                     } (every key is optional)
 # TOKEN_CONFIG := {
 #                   'id': string,
-#                   'token': string
+#                   'token': string,
+#                   'url': string, (optional)
+#                   'target': string (optional)
 #                  }
+# TARGET := {
+#             'name': str, ('' for the main account)
+#             'url': str,
+#             'mast': LazyMastodon
+#           }
 
 
 ### Logging
@@ -59,14 +136,130 @@ def access_token():
         return fl.read().strip()
 
 
+class LazyMastodon:
+    """A Mastodon instance that is created the first time it’s used.
+Importing mastodon.py and creating the client takes a while, and most
+runs don’t toot at all. KWARGS are passed to Mastodon()."""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.mast = None
+
+    def __getattr__(self, name):
+        if self.mast is None:
+            from mastodon import Mastodon
+            self.mast = Mastodon(**self.kwargs)
+        return getattr(self.mast, name)
+
+
 def error_code(err):
     """Return the error code for MastodonError ERR."""
-    err.args[1]
+    return err.args[1]
+
+
+def parse_instance_limits(info):
+    """Return INSTANCE_LIMITS in INFO, the response of /api/v2/instance
+or /api/v1/instance."""
+    configuration = info.get('configuration') or {}
+    statuses = configuration.get('statuses') or {}
+    media = configuration.get('media_attachments') or {}
+    limits = {
+        'max_characters': statuses.get('max_characters')
+        # Pleroma and older forks.
+        or info.get('max_toot_chars'),
+        'max_media_attachments': statuses.get('max_media_attachments'),
+        'characters_reserved_per_url':
+        statuses.get('characters_reserved_per_url'),
+        'image_size_limit': media.get('image_size_limit'),
+        'image_matrix_limit': media.get('image_matrix_limit'),
+        'video_size_limit': media.get('video_size_limit'),
+        'video_matrix_limit': media.get('video_matrix_limit'),
+    }
+    return {key: int(value) for key, value in limits.items()
+            if isinstance(value, (int, str)) and str(value).isdigit()}
+
+
+def fetch_instance_limits(url):
+    """Return INSTANCE_LIMITS of the instance at URL.
+Try /api/v2/instance first, then /api/v1/instance. Return None if
+neither works."""
+    import requests
+    import weibo
+
+    for path in ('/api/v2/instance', '/api/v1/instance'):
+        try:
+            resp = requests.get(url.rstrip('/') + path, timeout=10)
+            if resp.ok:
+                return parse_instance_limits(weibo.json_loads(resp.content))
+        except (requests.RequestException, ValueError, AttributeError) as err:
+            logger.warning(f'Couldn’t get instance information from {url}{path}: {err}')
+    return None
+
+
+# Maps instance urls to (INSTANCE_LIMITS, fetch time), so we don’t
+# read the database for every post.
+instance_limits_cache = {}
+
+
+def get_instance_limits(url, db):
+    """Return INSTANCE_LIMITS of the instance at URL.
+The limits are cached in DB for INSTANCE_LIMITS_TTL seconds. If the
+instance can’t be reached, return the cached limits even if they are
+stale, or an empty dictionary."""
+    with db.lock:
+        return get_instance_limits_locked(url, db)
+
+
+def get_instance_limits_locked(url, db):
+    """Do the work of get_instance_limits while holding DB’s lock."""
+    import weibo
+
+    cached = instance_limits_cache.get(url)
+    if cached == None:
+        row = db.execute('SELECT limits, fetched_at FROM InstanceLimits WHERE url = ?', [url]).fetchone()
+        if row:
+            cached = (weibo.json_loads(row[0]), row[1])
+    if cached and time.time() - cached[1] < INSTANCE_LIMITS_TTL:
+        instance_limits_cache[url] = cached
+        return cached[0]
+    limits = fetch_instance_limits(url)
+    if limits is None:
+        # Don’t ask again for every post, try again in 10 minutes.
+        limits = cached[0] if cached else {}
+        instance_limits_cache[url] = (
+            limits, time.time() - INSTANCE_LIMITS_TTL + 10 * 60)
+        return limits
+    fetched_at = time.time()
+    db.execute('INSERT OR REPLACE INTO InstanceLimits VALUES (?,?,?)',
+               (url, weibo.json_dumps(limits).decode('utf-8'), fetched_at))
+    db.commit()
+    instance_limits_cache[url] = (limits, fetched_at)
+    logger.info(f'Limits of {url}: {limits}')
+    return limits
+
+
+def toot_length(text, url_length=URL_LENGTH):
+    """Return the length of TEXT as Mastodon counts it.
+Every URL counts as URL_LENGTH characters, however long it is."""
+    return len(URL_PATTERN.sub('x' * url_length, text))
+
+
+def truncate_toot(text, limit, url_length=URL_LENGTH):
+    """Return the longest prefix of TEXT whose toot_length is at most LIMIT."""
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if toot_length(text[:middle], url_length) <= limit:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
 
 
 def collect_media_url(post, recursive=False):
     """Return a list of MEDIA_URL in POST.
-MEDIA_URL := {'type': str, 'url': str}.
+MEDIA_URL := {'type': str, 'url': str, 'variants': [str] (optional)}.
+'variants' lists every quality of a video, best first.
 If RECURSIVE is True, also include url's from original post."""
     url_list = []
 
@@ -75,8 +268,12 @@ If RECURSIVE is True, also include url's from original post."""
             url_list.append({'type': 'image', 'url': url})
 
     if post['video_url'] != '':
+        variants = post.get('video_variants') or []
         for url in post['video_url'].split(';'):
-            url_list.append({'type': 'video', 'url': url})
+            media_url = {'type': 'video', 'url': url}
+            if variants and url == variants[0]:
+                media_url['variants'] = variants
+            url_list.append(media_url)
 
     orig_post = post.get('retweet')
     if orig_post and recursive:
@@ -85,24 +282,366 @@ If RECURSIVE is True, also include url's from original post."""
     return url_list
 
 
-def upload_media(url_list, max_attatchment):
-    """Upload media in URL_LIST.
-URL_LIST should be a list of MEDIA_URL. Return (TOOT_LIST, TOO_LARGE,
-TOO_MANY). TOOT_LIST is a list of TOOT_DICT.
+def shrink_image(data, size_limit, quality, min_quality=40,
+                 pixel_limit=None):
+    """Re-encode image DATA so that it is no larger than SIZE_LIMIT bytes.
+Try JPEG qualities from QUALITY down to MIN_QUALITY, then downscale
+and try again. Images with transparency stay PNG and are only
+downscaled. Images with more than PIXEL_LIMIT pixels are downscaled
+first. Return (DATA, MIME), or None if Pillow is not installed, the
+image is animated or can’t be decoded, or it still doesn’t fit."""
+    try:
+        from PIL import Image
+    except ImportError:
+        logger.warning('Install Pillow to recompress oversized images')
+        return None
+    try:
+        image = Image.open(io.BytesIO(data))
+        if getattr(image, 'is_animated', False):
+            return None
+        keep_png = image.mode in ('RGBA', 'LA') \
+            or (image.mode == 'P' and 'transparency' in image.info)
+        if not keep_png:
+            image = image.convert('RGB')
+        if pixel_limit and image.width * image.height > pixel_limit:
+            scale = (pixel_limit / (image.width * image.height)) ** 0.5
+            image = image.resize((max(1, int(image.width * scale)),
+                                  max(1, int(image.height * scale))),
+                                 Image.LANCZOS)
+        for _ in range(6):
+            qualities = [None] if keep_png \
+                else range(quality, min_quality - 1, -10)
+            for q in qualities:
+                buf = io.BytesIO()
+                if keep_png:
+                    image.save(buf, 'PNG', optimize=True)
+                else:
+                    image.save(buf, 'JPEG', quality=q, optimize=True)
+                if buf.tell() <= size_limit:
+                    return (buf.getvalue(), 'image/png' if keep_png
+                            else 'image/jpeg')
+            # Byte size scales roughly with pixel count.
+            scale = min(0.9, (size_limit / buf.tell()) ** 0.5)
+            image = image.resize((max(1, int(image.width * scale)),
+                                  max(1, int(image.height * scale))),
+                                 Image.LANCZOS)
+    # UnidentifiedImageError is an OSError.
+    except (OSError, ValueError, Image.DecompressionBombError) as err:
+        logger.warning(f'Couldn’t recompress image: {err}')
+    return None
+
+
+def image_pixels(data):
+    """Return width times height of image DATA, or None if unknown."""
+    try:
+        from PIL import Image
+        with Image.open(io.BytesIO(data)) as image:
+            return image.width * image.height
+    except Exception:
+        return None
+
+
+def prepare_image(data, mime, media_config):
+    """Return (DATA, MIME) of an image that fits MEDIA_CONFIG.
+Return None if the image is too large and couldn’t be shrunk. An image
+that can’t be decoded is uploaded as is if it is small enough."""
+    size_limit = media_config['image_size_limit']
+    pixel_limit = media_config['image_matrix_limit']
+    too_large = len(data) > size_limit
+    if pixel_limit and not too_large:
+        pixels = image_pixels(data)
+        too_large = pixels != None and pixels > pixel_limit
+    large_png = mime == 'image/png' \
+        and len(data) > media_config['png_size_limit']
+    if media_config['recompress_images'] and (too_large or large_png):
+        shrunk = shrink_image(data, size_limit,
+                              media_config['image_quality'],
+                              pixel_limit=pixel_limit)
+        if shrunk and (too_large or len(shrunk[0]) < len(data)):
+            return shrunk
+    return None if too_large else (data, mime)
+
+
+def probe_size(url):
+    """Return the size in bytes of the file at URL, or None if unknown.
+Try HEAD first, then a one-byte Range request."""
+    import requests
+
+    try:
+        resp = requests.head(url, allow_redirects=True, timeout=10)
+        if resp.ok and resp.headers.get('content-length'):
+            return int(resp.headers['content-length'])
+        resp = requests.get(url, headers={'Range': 'bytes=0-0'},
+                            stream=True, timeout=10)
+        resp.close()
+        content_range = resp.headers.get('content-range', '')
+        if resp.status_code == 206 and '/' in content_range:
+            return int(content_range.split('/')[-1])
+    except (requests.RequestException, ValueError) as err:
+        logger.warning(f'Couldn’t probe size of {url}: {err}')
+    return None
+
+
+def select_video_variants(media_url, size_limit):
+    """Yield the urls of the videos in MEDIA_URL that are no larger than
+SIZE_LIMIT bytes, best quality first. A variant whose size can’t be
+probed is assumed to fit."""
+    for url in media_url.get('variants') or [media_url['url']]:
+        size = probe_size(url)
+        if size is None or size <= size_limit:
+            yield url
+        else:
+            logger.info(f'Video variant too large ({size} bytes): {url}')
+
+
+def fetch_video(media_url, size_limit, media_cache):
+    """Download the best quality video in MEDIA_URL that is no larger
+than SIZE_LIMIT bytes through MEDIA_CACHE. If a variant turns out to
+be too large after all, try the next one. Return (CONTENT, MIME, URL),
+or None if none of them fits."""
+    for url in select_video_variants(media_url, size_limit):
+        content, mime = media_cache.get(url)
+        if len(content) <= size_limit:
+            return content, mime, url
+        logger.info(f'Video variant too large ({len(content)} bytes) after download: {url}')
+    return None
+
+
+class MediaPending(Exception):
+    """Media of a post isn’t ready yet, post it on a later cycle."""
+
+
+# Runs ffmpeg in the background, created on first use. Maps output
+# paths to the futures of their transcodes.
+transcode_executor = None
+transcode_futures = {}
+transcode_lock = threading.Lock()
+
+
+def get_transcode_executor(workers):
+    """Return the executor that runs WORKERS transcodes at once."""
+    global transcode_executor
+    if transcode_executor == None:
+        transcode_executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='transcode')
+    return transcode_executor
+
+
+def evict_transcode_cache(size_limit):
+    """Remove the least recently used videos in TRANSCODE_DIR until it
+is no larger than SIZE_LIMIT bytes."""
+    files = []
+    for entry in os.scandir(TRANSCODE_DIR):
+        if entry.is_file() and entry.name.endswith('.mp4') \
+           and not entry.name.endswith('.tmp.mp4'):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= size_limit:
+            break
+        os.remove(path)
+        total -= size
+
+
+def run_low_priority(args):
+    """Run ARGS niced so it doesn’t starve the crawler and poster."""
+    import shutil
+
+    # Not preexec_fn, that isn’t safe with our other threads running.
+    nice = shutil.which('nice')
+    if nice:
+        args = [nice, '-n', '10'] + args
+    return subprocess.run(args, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, timeout=30 * 60,
+                          check=True)
+
+
+def probe_duration(path, media_config):
+    """Return the duration of video file PATH in seconds."""
+    proc = run_low_priority(
+        [media_config['ffprobe_path'], '-v', 'error', '-show_entries',
+         'format=duration', '-of', 'csv=p=0', path])
+    return float(proc.stdout.strip())
+
+
+def transcode_video(media_url, media_config):
+    """Re-encode the smallest variant of MEDIA_URL to fit MEDIA_CONFIG.
+The output is cached under TRANSCODE_DIR by source file id and budget,
+so a video that failed to post is only transcoded once, and so is a
+video that can’t be made to fit. Transcoding runs in the background:
+the first call starts it and raises MediaPending, a call after it
+finished returns the encoded bytes, or None if it can’t be made to
+fit."""
+    import requests
+
+    source = (media_url.get('variants') or [media_url['url']])[-1]
+    size_limit = media_config['video_size_limit']
+    duration_limit = media_config['video_duration_limit']
+    source_id = os.path.splitext(
+        requests.utils.urlparse(source).path.split('/')[-1])[0]
+    out_path = os.path.join(
+        TRANSCODE_DIR, f'{source_id}_{size_limit}_{duration_limit}.mp4')
+    with transcode_lock:
+        future = transcode_futures.get(out_path)
+        if future != None:
+            if not future.done():
+                raise MediaPending(f'transcoding {source}')
+            del transcode_futures[out_path]
+        if os.path.isfile(out_path):
+            # Keep recently used videos when evicting.
+            os.utime(out_path)
+            with open(out_path, 'rb') as fl:
+                return fl.read()
+        # The failure is remembered on disk, so the next run doesn’t
+        # try again either.
+        if future != None or os.path.isfile(out_path + '.failed'):
+            return None
+        transcode_futures[out_path] = get_transcode_executor(
+            media_config['transcode_workers']).submit(
+                transcode_video_to, source, out_path, media_config)
+        logger.info(f'Transcoding {source} in the background')
+        raise MediaPending(f'transcoding {source}')
+
+
+def transcode_video_to(source, out_path, media_config):
+    """Re-encode video at url SOURCE to OUT_PATH, see transcode_video.
+If it can’t be made to fit, create OUT_PATH.failed instead."""
+    import requests
+
+    size_limit = media_config['video_size_limit']
+    duration_limit = media_config['video_duration_limit']
+    os.makedirs(TRANSCODE_DIR, exist_ok=True)
+    src_path = out_path + '.src'
+    tmp_path = out_path + '.tmp.mp4'
+    threads = str(media_config['transcode_threads'])
+    # Keep 16:9 videos within the instance’s pixel limit.
+    max_height = 720
+    if media_config['video_matrix_limit']:
+        max_height = min(max_height, int(
+            (media_config['video_matrix_limit'] * 9 / 16) ** 0.5) // 2 * 2)
+    try:
+        with requests.get(source, stream=True, timeout=30) as resp:
+            resp.raise_for_status()
+            with open(src_path, 'wb') as fl:
+                for chunk in resp.iter_content(1024 * 1024):
+                    fl.write(chunk)
+        duration = probe_duration(src_path, media_config)
+        if duration_limit:
+            duration = min(duration, duration_limit)
+        if not duration > 0:
+            logger.warning(f'Video has no duration, not transcoding: {source}')
+            return
+        # Leave 5% for container overhead, 64k for audio.
+        bitrate = size_limit * 8 * 0.95 / duration - 64000
+        for _ in range(2):
+            if bitrate < 100000:
+                logger.warning(f'Video too long to transcode within budget: {source}')
+                return
+            args = [media_config['ffmpeg_path'], '-y', '-v', 'error',
+                    '-i', src_path, '-threads', threads,
+                    '-vf', f"scale=-2:'min({max_height},ih)'",
+                    '-c:v', 'libx264', '-preset', 'veryfast',
+                    '-b:v', str(int(bitrate)),
+                    '-maxrate', str(int(bitrate)),
+                    '-bufsize', str(int(bitrate * 2)),
+                    '-c:a', 'aac', '-b:a', '64k',
+                    '-movflags', '+faststart']
+            if duration_limit:
+                args += ['-t', str(duration_limit)]
+            run_low_priority(args + [tmp_path])
+            if os.path.getsize(tmp_path) <= size_limit:
+                os.replace(tmp_path, out_path)
+                evict_transcode_cache(media_config['transcode_cache_size'])
+                return
+            bitrate *= 0.8
+    except (requests.RequestException, OSError, ValueError,
+            subprocess.SubprocessError) as err:
+        logger.warning(f'Couldn’t transcode {source}: {err}')
+    finally:
+        for path in (src_path, tmp_path):
+            if os.path.isfile(path):
+                os.remove(path)
+        if not os.path.isfile(out_path):
+            open(out_path + '.failed', 'wb').close()
+
+
+class MediaCache:
+    """Media downloaded for one post, shared by all of its targets.
+Each url is downloaded at most once, even when several threads ask
+for it at the same time."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.url_locks = {}
+        self.media = {}
+
+    def get(self, url):
+        """Return (CONTENT, MIME) of the file at URL."""
+        import requests
+
+        with self.lock:
+            url_lock = self.url_locks.setdefault(url, threading.Lock())
+        with url_lock:
+            if url not in self.media:
+                resp = requests.get(url)
+                mime = resp.headers['content-type'].split(';')[0].strip()
+                self.media[url] = (resp.content, mime)
+            return self.media[url]
+
+
+def upload_media(url_list, max_attatchment, mast, media_config,
+                 media_cache=None):
+    """Upload media in URL_LIST with MAST.
+URL_LIST should be a list of MEDIA_URL. Images that exceed the limits
+in MEDIA_CONFIG are recompressed or skipped instead of being uploaded
+only to be rejected. Files are downloaded through MEDIA_CACHE, a
+MediaCache. Return (TOOT_LIST, TOO_LARGE, TOO_MANY).
+TOOT_LIST is a list of TOOT_DICT.
 """
+    from mastodon import MastodonAPIError
+
+    if media_cache == None:
+        media_cache = MediaCache()
     media_list = []
     media_too_large = False
     media_too_many = False
     if len(url_list) > max_attatchment:
         url_list = url_list[:max_attatchment]
         media_too_many = True
-    for media_url in url_list:
+    # Get the videos first, so nothing is uploaded if one of them is
+    # still being transcoded.
+    videos = {}
+    for idx, media_url in enumerate(url_list):
+        if media_url['type'] == 'video':
+            video = fetch_video(media_url, media_config['video_size_limit'],
+                                media_cache)
+            if video is None and media_config['transcode_videos']:
+                content = transcode_video(media_url, media_config)
+                if content != None:
+                    video = (content, 'video/mp4', media_url['url'])
+            videos[idx] = video
+    for idx, media_url in enumerate(url_list):
         url = media_url['url']
-        resp = requests.get(url)
-        mime = resp.headers['content-type'].split(';')[0].strip()
+        if media_url['type'] == 'video':
+            video = videos[idx]
+            if video is None:
+                media_too_large = True
+                logger.warning(f'Video too large, skipped, url: {media_url["url"]}')
+                continue
+            content, mime, url = video
+        else:
+            content, mime = media_cache.get(url)
+        if media_url['type'] == 'image':
+            image = prepare_image(content, mime, media_config)
+            if image is None:
+                media_too_large = True
+                logger.warning(f'Image too large, skipped, url: {url}')
+                continue
+            content, mime = image
         # https://mastodonpy.readthedocs.io/en/stable/#media-post
         try:
-            ret = mast.media_post(resp.content, mime)
+            ret = mast.media_post(content, mime)
             media_list.append(ret)
         except MastodonAPIError as err:
             if error_code(err) == 422:
@@ -111,17 +650,68 @@ TOO_MANY). TOOT_LIST is a list of TOOT_DICT.
     return (media_list, media_too_large, media_too_many)
 
 
-def cross_post(post, mast_dict, config, db, fallback_mast=None):
-    """Cross-post POST to mastodon.
-MAST_DICT is a hash map from weibo author ids (string) to Mastodon
-instances. Return a list of POST_RECORD. FALLBACK_MAST is used when we
-cannot find a Mastodon instance from dict for the weibo author.
+def get_media_config(user_id, config, limits={}):
+    """Return the MEDIA_CONFIG for USER_ID.
+Size limits default to, and never exceed, those in INSTANCE_LIMITS
+LIMITS."""
+    def size_limit(option, default):
+        value = get_user_option(user_id, option, config,
+                                limits.get(option, default))
+        return min(value, limits[option]) if option in limits else value
+
+    return {
+        'recompress_images': get_user_option(
+            user_id, 'recompress_images', config, False),
+        'image_size_limit': size_limit('image_size_limit',
+                                       8 * 1024 * 1024),
+        'image_quality': get_user_option(
+            user_id, 'image_quality', config, 85),
+        'png_size_limit': get_user_option(
+            user_id, 'png_size_limit', config, 2 * 1024 * 1024),
+        'video_size_limit': size_limit('video_size_limit',
+                                       40 * 1024 * 1024),
+        'transcode_videos': get_user_option(
+            user_id, 'transcode_videos', config, False),
+        'video_duration_limit': get_user_option(
+            user_id, 'video_duration_limit', config, None),
+        'image_matrix_limit': limits.get('image_matrix_limit'),
+        'video_matrix_limit': limits.get('video_matrix_limit'),
+        'ffmpeg_path': config.get('ffmpeg_path', 'ffmpeg'),
+        'ffprobe_path': config.get('ffprobe_path', 'ffprobe'),
+        'transcode_workers': config.get('transcode_workers', 1),
+        'transcode_threads': config.get('transcode_threads', 2),
+        'transcode_cache_size': config.get('transcode_cache_size',
+                                           TRANSCODE_CACHE_SIZE)
+    }
+
+
+def cross_post(post, target, config, db, media_cache=None):
+    """Cross-post POST to TARGET.
+Return a list of POST_RECORD. MEDIA_CACHE is a MediaCache shared with
+the other targets of POST.
 """
-    if not should_cross_post(post, config, db):
+    if not should_cross_post(post, config, db, target['name']):
         return []
 
-    len_limit = config['toot_len_limit'] - 100
-    max_attatchment = config['max_attachment_count']
+    text, media_list, orig_toot_id, post_record_list = \
+        compose_toot(post, target, config, db, media_cache)
+    toot = target['mast'].status_post(text, in_reply_to_id=orig_toot_id,
+                                      media_ids=media_list)
+    post_record_list.append(make_post_record(post, toot, target['name']))
+    return post_record_list
+
+
+def compose_toot(post, target, config, db, media_cache=None):
+    """Compose the toot for POST on TARGET, uploading its media.
+Return (TEXT, MEDIA_LIST, ORIG_TOOT_ID, POST_RECORD_LIST), where
+ORIG_TOOT_ID is the toot to reply to, and POST_RECORD_LIST records the
+original post if it had to be cross posted first."""
+    limits = get_instance_limits(target['url'], db)
+    len_limit = config.get('toot_len_limit') \
+        or limits.get('max_characters', 500)
+    max_attatchment = config.get('max_attachment_count') \
+        or limits.get('max_media_attachments', 4)
+    url_length = limits.get('characters_reserved_per_url', URL_LENGTH)
     user_id = str(post['user_id'])
     # external_media is specific to monado.ren.
     external_media = get_user_option(user_id, 'external_media', config)
@@ -132,6 +722,7 @@ cannot find a Mastodon instance from dict for the weibo author.
                                        config)
     post_record_list = []
     orig_toot_id = None
+    mast = target['mast']
 
     # Maybe upload media.
     url_list = collect_media_url(post, not standalone_repost)
@@ -140,15 +731,9 @@ cannot find a Mastodon instance from dict for the weibo author.
     media_too_many = False
     if not external_media:
         media_list, media_too_large, media_too_many = \
-            upload_media(url_list, max_attatchment)
-
-    # Come up with a Mastodon instance for tooting.
-    mast = mast_dict.get(user_id)
-    if mast == None:
-        if fallback_mast != None:
-            mast = fallback_mast
-        else:
-            raise KeyError('Couldn\'t find a Mastodon instance to toot with')
+            upload_media(url_list, max_attatchment, mast,
+                         get_media_config(user_id, config, limits),
+                         media_cache)
 
     # Compose toot.
     # 1. Compose body text.
@@ -170,16 +755,17 @@ cannot find a Mastodon instance from dict for the weibo author.
         if standalone_repost:
             # If the original weibo is already cross posted, we don’t
             # cross post it again.
-            orig_toot_id = get_toot_by_weibo(orig_post, db)
+            orig_toot_id = get_toot_by_weibo(orig_post, db, target['name'])
             if orig_toot_id == None:
-                orig_record_list = cross_post(orig_post, mast_dict,
-                                              config, db, mast)
+                orig_record_list = cross_post(orig_post, target,
+                                              config, db, media_cache)
                 if len(orig_record_list) > 0:
                     orig_toot_id = orig_record_list[0][0]
                 post_record_list += orig_record_list
             body += '#转_bot\n\n'
-        elif get_toot_by_weibo(post, db) != None:
-            orig_toot_id = get_toot_by_weibo(post, db)
+        elif get_toot_by_weibo(orig_post, db, target['name']) != None:
+            # The original post is cross posted already, reply to it.
+            orig_toot_id = get_toot_by_weibo(orig_post, db, target['name'])
             body += '#转_bot\n\n'
         else:
             body += '转_bot #{0}_bot\n\n{1}\n\n'.format(
@@ -197,11 +783,16 @@ cannot find a Mastodon instance from dict for the weibo author.
         postamble += '（有些视频图片太多太大，传不了，完整版看原微博）\n'
         include_post_url = True
 
-    # 5. Maybe truncate the post.
+    # 5. Maybe truncate the post. Always leave room for the post url,
+    # because truncating adds it.
+    post_url = f'https://m.weibo.cn/detail/{post["id"]}'
+    source_line = f'源：{post_url}\n'
     cutoff_notice = '……\n\n（太长了，完整版看原微博）\n'
-    body_limit = len_limit - len(postamble) - 25
-    if len(body) > body_limit:
-        body = body[:body_limit - len(cutoff_notice)]
+    body_limit = len_limit - toot_length(postamble + source_line,
+                                         url_length)
+    if toot_length(body, url_length) > body_limit:
+        body = truncate_toot(body, body_limit - len(cutoff_notice),
+                             url_length)
         text = body + cutoff_notice + postamble
         include_post_url = True
     else:
@@ -209,17 +800,129 @@ cannot find a Mastodon instance from dict for the weibo author.
 
     # 6. Maybe add post url.
     if include_post_url:
-        post_url = f'https://m.weibo.cn/detail/{post["id"]}'
-        text += f'源：{post_url}\n'
+        text += source_line
 
     # 7. If this is a lottery post, replace with placeholder text
     if '微博抽奖平台' in post['text'] or '转发抽奖' in post['text']:
        text = '（没意思的抽奖微博）'
 
-    # 8. Toot!
-    toot = mast.status_post(text, in_reply_to_id=orig_toot_id,
-                            media_ids=media_list)
-    post_record_list.append(make_post_record(post, toot))
+    return text, media_list, orig_toot_id, post_record_list
+
+
+def cross_post_all(post, mast_dict, config, db):
+    """Cross-post POST to every target of its author, concurrently.
+MAST_DICT is a hash map from weibo author ids (string) to lists of
+TARGET. Media is downloaded once and uploaded to each target. Return a
+list of (TARGET, POST_RECORD list, exception or None), an error on one
+target doesn’t affect the others. The workers touch DB only through
+PostIndex and get_instance_limits, which hold DB’s lock; records are
+written by the caller."""
+    from mastodon import MastodonError
+
+    targets = mast_dict.get(str(post['user_id']))
+    if not targets:
+        raise KeyError('Couldn\'t find a Mastodon instance to toot with')
+    # Look up the limits here, so the threads find them in the cache.
+    for target in targets:
+        get_instance_limits(target['url'], db)
+    media_cache = MediaCache()
+
+    def post_to(target):
+        try:
+            return (target, cross_post(post, target, config, db,
+                                       media_cache), None)
+        except (MastodonError, MediaPending) as err:
+            return (target, [], err)
+        except Exception as err:
+            logger.exception(f'Unexpected error cross posting {post["id"]}')
+            return (target, [], err)
+
+    if len(targets) == 1:
+        return [post_to(targets[0])]
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        return list(executor.map(post_to, targets))
+
+
+def post_content_hash(post):
+    """Return a hash of the parts of POST that end up in its toot."""
+    import weibo
+
+    parts = [post['text'], post['pics'], post['video_url']]
+    if post.get('retweet'):
+        retweet = post['retweet']
+        parts += [retweet['id'], retweet['text'], retweet['pics'],
+                  retweet['video_url']]
+    return hashlib.md5(weibo.json_dumps(parts)).hexdigest()
+
+
+def sync_posts(post_list, windows, mast_dict, config, db, unsettled=None):
+    """Update or delete the toots of recent posts that changed on weibo.
+POST_LIST is the list of posts crawled this time, WINDOWS maps user
+ids to their first page, see get_weibo_posts. Only posts within the
+first page are looked at, so this doesn’t need any request to weibo.
+A post is deleted only after it is missing from two fetches of the
+page in a row, so one bad response doesn’t delete anything. The ids
+of users with such posts waiting to be confirmed are added to the set
+UNSETTLED, so their page is fetched again next time. Return True if
+every update and deletion went fine."""
+    from mastodon import MastodonError
+
+    ok = True
+    for user_id, (low, high, page_ids) in windows.items():
+        targets = mast_dict.get(user_id, [])
+        if not targets \
+           or not get_user_option(user_id, 'sync_edits', config):
+            continue
+        posts = {str(post['id']): post for post in post_list
+                 if str(post['user_id']) == user_id}
+        # Everything we tooted between the oldest and the newest post
+        # on the first page should still be on it.
+        rows = db.execute('SELECT toot_id, weibo_id, target, content_hash FROM Post WHERE user_id = ? AND toot_id != \'\' AND CAST(weibo_id AS INTEGER) BETWEEN ? AND ?', [user_id, low, high]).fetchall()
+        missing = {weibo_id for _, weibo_id, _, _ in rows
+                   if int(weibo_id) not in page_ids}
+        confirmed = missing & get_missing_posts(user_id, db)
+        record_missing_posts(user_id, missing, db)
+        if missing - confirmed and unsettled != None:
+            unsettled.add(user_id)
+        for toot_id, weibo_id, name, content_hash in rows:
+            target = get_match('name', name, targets)
+            if target == None:
+                continue
+            post = posts.get(weibo_id)
+            try:
+                if weibo_id in missing:
+                    if weibo_id not in confirmed:
+                        logger.debug(f'{weibo_id} of {user_id} is gone, '
+                                     'deleting it if it is still gone '
+                                     'next time')
+                        continue
+                    delete_toot(toot_id, target['mast'])
+                    record_deletion(weibo_id, name, db)
+                    logger.info(u'删除了%s的已删除微博%s', user_id, weibo_id)
+                elif post == None:
+                    continue
+                elif not content_hash:
+                    # Tooted before we stored hashes, start from here.
+                    record_content_hash(post, name, db)
+                elif content_hash != post_content_hash(post):
+                    records = update_toot(post, toot_id, target, config, db)
+                    record_success(records, db)
+                    record_content_hash(post, name, db)
+                    logger.info(u'更新了%s修改过的微博%s', user_id, weibo_id)
+            except MastodonError as err:
+                logger.warning(u'试图同步%s的微博%s，但没有成功：%s',
+                               user_id, weibo_id, str(err))
+                ok = False
+    return ok
+
+
+def update_toot(post, toot_id, target, config, db):
+    """Edit toot TOOT_ID on TARGET to match POST.
+Return a list of POST_RECORD for the original post, if it had to be
+cross posted first."""
+    text, media_list, _, post_record_list = \
+        compose_toot(post, target, config, db)
+    target['mast'].status_update(toot_id, text, media_ids=media_list)
     return post_record_list
     
 
@@ -239,6 +942,8 @@ def delete_all_toots(mast):
                 
 def delete_toot(toot_id, mast):
     """Delete toot with TOOT_ID."""
+    from mastodon import MastodonNotFoundError
+
     try:
         mast.status_delete(toot_id)
     except MastodonNotFoundError:
@@ -248,9 +953,10 @@ def delete_toot(toot_id, mast):
 
 def get_match(key, value, lst):
     """Return the element that contains KEY: VALUE in list LST.
-Return None if none found."""
+Values are compared as strings, so ids written as numbers in
+config.json still match. Return None if none found."""
     for elm in lst:
-        if elm[key] == value:
+        if str(elm[key]) == str(value):
             return elm
     return None
 
@@ -260,58 +966,111 @@ def post_repost_p(post):
     return True if post.get('retweet') else False
 
 
-def get_user_option(user_id, option, config):
-    """Return the value of OPTION in USER_ID's USER_CONFIG in CONFIG."""
+def get_user_option(user_id, option, config, default=None):
+    """Return the value of OPTION in USER_ID's USER_CONFIG in CONFIG.
+Fall back to CONFIG, then to DEFAULT. A user’s false or 0 overrides
+CONFIG as well."""
     user_list = config['user_list']
     user = get_match('id', user_id, user_list)
-    if user and user.get(option):
-        return user.get(option)
+    if user and option in user:
+        return user[option]
     else:
-        return config[option]
+        return config.get(option, default)
 
-def get_weibo_posts(config, db):
+def get_weibo_posts(config, db, windows=None, fingerprints=None):
     """Return a list of weibo posts.
 CONFIG is the configuration dictionary described in README.md.
-DB is the database."""
+DB is the database. A user that fails is recorded in DB and skipped
+until its backoff runs out, the other users are not affected. If
+WINDOWS is a dictionary, map the ids of users whose first page
+changed to (LOW, HIGH, IDS), where IDS is the set of post ids on it,
+and LOW and HIGH are the smallest and largest of them, not counting
+the pinned post.
+FINGERPRINTS, a dictionary, maps the ids of users whose first page
+changed and parsed completely to its new fingerprint; record them with
+record_page_fingerprint once the posts are cross posted."""
+    import weibo
+
     post_list = []
     wb = weibo.Weibo(make_weibo_config(config))
     for user in wb.user_config_list:
-        wb.initialize_info(user)
-        # We have to get user_info first, ‘get_one_page’ uses
-        # information retrieved by it.
-        wb.get_user_info()
-        # Only crawl the first page, that should be more than
-        # enough.
-        wb.get_one_page(1)
-        post_list += reversed(wb.weibo)
+        user_id = user['user_id']
+        health = get_user_health(user_id, db)
+        if health != None and health[4] > time.time():
+            logger.debug(f'{user_id} is backing off until '
+                         f'{datetime.fromtimestamp(health[4]):%H:%M}')
+            continue
+        try:
+            post_list += get_user_posts(wb, user, db, windows, fingerprints)
+        except Exception as err:
+            record_user_failure(user_id, err, db)
+        else:
+            if health != None:
+                record_user_success(user_id, db)
+    # Don’t leave crawled rows sitting in the buffer while we sleep.
+    weibo.csv_writer.flush()
 
     return post_list
 
 
-def should_cross_post(post, config, db):
-    """If the POST (a dictionary) should be posted, return True.
-DB is the database."""
+def get_user_posts(wb, user, db, windows=None, fingerprints=None):
+    """Return a list of new weibo posts of USER, crawled with WB.
+Raise an exception if the user’s account can’t be read, e.g., it is
+deleted, banned or private. See get_weibo_posts for WINDOWS and
+FINGERPRINTS."""
+    wb.initialize_info(user)
+    # Only crawl the first page, that should be more than
+    # enough. If it didn’t change since last time, there is
+    # nothing new to cross post.
+    page = wb.get_weibo_json(1)
+    fingerprint = wb.get_page_fingerprint(page)
+    if fingerprint != None \
+       and fingerprint == get_page_fingerprint(user['user_id'], db):
+        logger.debug(f'{user["user_id"]} has no new posts')
+        return []
+    # We have to get user_info first, ‘get_one_page’ uses
+    # information retrieved by it.
+    if wb.get_user_info() == None:
+        raise ValueError(page.get('msg') or 'user info is unavailable')
+    wb.get_one_page(1, page)
+    # If a post was dropped, look at the page again next time.
+    if fingerprints != None and fingerprint != None \
+       and wb.failed_count == 0:
+        fingerprints[str(user['user_id'])] = fingerprint
+    if windows != None and page.get('ok'):
+        cards = [card for card in page['data']['cards']
+                 if card.get('card_type') == 9]
+        # A pinned post can be much older than the rest of the page,
+        # so it doesn’t count for the window, but it is still there.
+        window = [int(card['mblog']['id']) for card in cards
+                  if not wb.is_pinned_weibo(card)]
+        if window:
+            windows[str(user['user_id'])] = (
+                min(window), max(window),
+                {int(card['mblog']['id']) for card in cards})
+    return list(reversed(wb.weibo))
+
+
+def should_cross_post(post, config, db, target=''):
+    """If the POST (a dictionary) should be posted to TARGET, return True.
+DB is the database. TARGET is the name of a TARGET."""
     include_repost = get_user_option(
         str(post['user_id']), 'include_repost', config)
-    if cross_posted_p(post, db) \
+    if cross_posted_p(post, db, target) \
        or ((not include_repost) and post_repost_p(post)) \
-       or failed_many_times(post, db):
+       or failed_many_times(post, db, target):
         # TODO: Other filters.
         return False
     else:
         return True
 
 
-def failed_many_times(post, db):
-    """Return True if POST failed too many times.
+def failed_many_times(post, db, target=''):
+    """Return True if POST failed too many times on TARGET.
 DB records the number of times POST failed to cross post.
 POST is a dictionary."""
-    weibo_id = str(post['id'])
-    fail_count = db.execute('SELECT fail_count FROM Post WHERE weibo_id = ?', [weibo_id]).fetchone()
-    if fail_count == None:
-        return False
-    else:
-        return fail_count > 3
+    entry = db.index.get(str(post['id']), target)
+    return entry != None and entry[1] > 3
 
 ### Config
 
@@ -347,18 +1106,19 @@ def validate_config(config):
 Python will emit KeyError."""
     for user in config['user_list']:
         user['id']
-    config['mastodon_instance_url'], config['toot_len_limit'],
-    config['max_attachment_count'], config['standalone_repost'],
+    config['mastodon_instance_url'], config['standalone_repost'],
     config['include_repost'], config['include_post_url']
 
 
 def get_config(config_file, validator=validate_config):
     """Return the config dictionary."""
+    import weibo
+
     config_path = os.path.split(os.path.realpath(__file__))[0] \
         + os.sep + config_file
     try:
-        with open(config_path, 'r') as fl:
-            config = json.load(fl)
+        with open(config_path, 'rb') as fl:
+            config = weibo.json_loads(fl.read())
         validator(config)
         return config
 
@@ -385,12 +1145,15 @@ Python will emit KeyError."""
 
 def get_mast_dict(token_file, url):
     """Return a MAST_DICT.
-MAST_DICT is a hash map from weibo author id (string) to Mastodon
-instances.
+MAST_DICT is a hash map from weibo author id (string) to a list of
+TARGET. Most authors have a single target on URL, the main instance;
+token entries with a ‘url’ or ‘target’ add mirrors. The instances are
+LazyMastodon’s, so nothing is created until an author actually has
+something to toot.
 TOKEN_FILE is the filename for the token file.
 """
     # Because multiple weibo authors could share a single token, we
-    # create an auxiliary dictionary mapping tokens to Mastodon
+    # create an auxiliary dictionary mapping (url, token) to Mastodon
     # instances. Then we map authors to instances by their assigned
     # token. This way we avoid creating duplicate instances for the
     # same token for different authors.
@@ -398,55 +1161,135 @@ TOKEN_FILE is the filename for the token file.
     token_config = get_config(token_file, validate_token)
     mast_dict = {}
     for user in token_config:
-        id = user['id']
-        token = access_token=user['token']
-        if token_instance_map.get(token) != None:
-            # Instance already created, use it.
-            mast_dict[id] = token_instance_map.get(token)
-        else:
+        id = str(user['id'])
+        token = user['token']
+        target_url = user.get('url') or url
+        name = user.get('target',
+                        '' if target_url.rstrip('/') == url.rstrip('/')
+                        else target_url)
+        targets = mast_dict.setdefault(id, [])
+        if get_match('name', name, targets) != None:
+            logger.warning(f'{id} has two targets named "{name}", '
+                           'ignoring the second one')
+            continue
+        key = (target_url, token)
+        if token_instance_map.get(key) == None:
             # Instance doesn’t exist, create it.
-            mast = Mastodon(access_token=token,
-                            api_base_url=url, request_timeout=30)
-            mast_dict[id] = mast
-            token_instance_map[token] = mast
+            token_instance_map[key] = LazyMastodon(
+                access_token=token, api_base_url=target_url,
+                request_timeout=30)
+        targets.append({'name': name, 'url': target_url,
+                        'mast': token_instance_map[key]})
     return mast_dict
 
 
 ### Database
 
+class PostIndex:
+    """A bounded in-memory copy of the Post table.
+Map INDEX_KEY to INDEX_ENTRY, so checking whether a post is already
+cross posted to a target doesn’t need a query. The most recent
+MAX_SIZE rows are loaded at startup; older rows are looked up on
+demand. Writers must call put() after changing the table
+(write-through). Safe to use from several threads, lookups that miss
+query DB while holding its lock."""
+
+    def __init__(self, db, max_size=POST_INDEX_SIZE):
+        self.db = db
+        self.max_size = max_size
+        self.lock = db.lock
+        self.entries = OrderedDict()
+        rows = db.execute('SELECT target, weibo_id, toot_id, fail_count FROM Post ORDER BY rowid DESC LIMIT ?', [max_size + 1]).fetchall()
+        # If every row fits, a miss means the post is not in the table.
+        self.complete = len(rows) <= max_size
+        for target, weibo_id, toot_id, fail_count in reversed(rows[:max_size]):
+            self.entries[(target or '', weibo_id)] = \
+                (toot_id or None, fail_count or 0)
+
+    def get(self, weibo_id, target=''):
+        """Return the INDEX_ENTRY for WEIBO_ID on TARGET, or None if
+not in the table."""
+        key = (target, weibo_id)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            if self.complete:
+                return None
+            row = self.db.execute('SELECT toot_id, fail_count FROM Post WHERE weibo_id = ? AND target = ?', [weibo_id, target]).fetchone()
+            entry = (row[0] or None, row[1] or 0) if row else None
+            self.put(weibo_id, entry, target)
+            return entry
+
+    def put(self, weibo_id, entry, target=''):
+        """Set the INDEX_ENTRY for WEIBO_ID on TARGET, evicting the
+oldest entry if full."""
+        key = (target, weibo_id)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.complete = False
+
+
+class PostDatabase(sqlite3.Connection):
+    """A connection to DATABASE_FILE with a PostIndex in INDEX.
+Worker threads share the connection, they must hold LOCK while using
+it, see cross_post_all."""
+    index = None
+    lock = None
+
+
 def get_db():
     """Return the database."""
-    connection = sqlite3.connect(DATABASE_FILE)
+    # Targets cross post from worker threads, see cross_post_all.
+    connection = sqlite3.connect(DATABASE_FILE, factory=PostDatabase,
+                                 check_same_thread=False)
     # If the table is not created, create it.
-    connection.execute('CREATE TABLE if not exists Post (toot_id text, weibo_id text, user_id text, user_name text, post_sum text, post_time text, fail_count integer);')
+    connection.execute('CREATE TABLE if not exists Post (toot_id text, weibo_id text, user_id text, user_name text, post_sum text, post_time text, fail_count integer, target text DEFAULT \'\', content_hash text DEFAULT \'\');')
+    # Databases created before mirrors existed lack the target column,
+    # their rows belong to the main account. Likewise for content_hash.
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(Post)')]
+    if 'target' not in columns:
+        connection.execute('ALTER TABLE Post ADD COLUMN target text DEFAULT \'\'')
+    if 'content_hash' not in columns:
+        connection.execute('ALTER TABLE Post ADD COLUMN content_hash text DEFAULT \'\'')
+    connection.execute('CREATE INDEX if not exists PostWeiboTarget ON Post (weibo_id, target);')
+    connection.execute('CREATE TABLE if not exists PageFingerprint (user_id text PRIMARY KEY, fingerprint text);')
+    connection.execute('CREATE TABLE if not exists InstanceLimits (url text PRIMARY KEY, limits text, fetched_at real);')
+    connection.execute('CREATE TABLE if not exists UserHealth (user_id text PRIMARY KEY, fail_count integer, last_error text, failed_at real, retry_at real);')
+    connection.execute('CREATE TABLE if not exists MissingPost (user_id text, weibo_id text, PRIMARY KEY (user_id, weibo_id));')
+    connection.lock = threading.RLock()
+    connection.index = PostIndex(connection)
     return connection
 
 
-def cross_posted_p(post, db):
-    """Return True if POST is in DB.
+def cross_posted_p(post, db, target=''):
+    """Return True if POST is in DB for TARGET.
 POST is a dictionary returned by Weibo.get_one_weibo()."""
-    return get_toot_by_weibo(post, db) != None
+    return get_toot_by_weibo(post, db, target) != None
 
 
-def get_toot_by_weibo(post, db):
-    """Return TOOT_ID that corresponds to POST in DB.
+def get_toot_by_weibo(post, db, target=''):
+    """Return TOOT_ID that corresponds to POST on TARGET in DB.
 Could return None. POST is a dictionary.
 """
-    weibo_id = str(post['id'])
-    cur = db.execute('SELECT toot_id FROM Post WHERE weibo_id = ?', [weibo_id])
-    return cur.fetchone()
+    entry = db.index.get(str(post['id']), target)
+    return entry[0] if entry else None
 
-def get_record_by_weibo(post, db):
-    """Return a dictionary of the record for POST in DB.
+def get_record_by_weibo(post, db, target=''):
+    """Return a dictionary of the record for POST on TARGET in DB.
 POST is a dictionary.
 """
     weibo_id = str(post['id'])
-    cur = db.execute('SELECT * FROM Post WHERE weibo_id = ?', [weibo_id])
+    cur = db.execute('SELECT * FROM Post WHERE weibo_id = ? AND target = ?',
+                     [weibo_id, target])
     return cur.fetchone()
 
 
-def make_post_record(post, toot):
-    """Return a POST_RECORD composed with POST and TOOT.
+def make_post_record(post, toot, target=''):
+    """Return a POST_RECORD composed with POST and TOOT, for TARGET.
 POST is the data structure returned from weibo-crawler."""
     return (
         toot['id'],
@@ -455,12 +1298,14 @@ POST is the data structure returned from weibo-crawler."""
         unicodedata.normalize('NFC', post['screen_name']),
         post['text'][:20],
         datetime.now().isoformat(),
-        0
+        0,
+        target,
+        post_content_hash(post)
     )
 
 
-def record_failure(post, db):
-    """Record a failure to cross post POST in DB.
+def record_failure(post, db, target=''):
+    """Record a failure to cross post POST to TARGET in DB.
 POST is a dictionary."""
     weibo_id = str(post['id'])
     summary = post['text'][:20]
@@ -468,24 +1313,126 @@ POST is a dictionary."""
     user_name = unicodedata.normalize('NFC', post['screen_name'])
     post_time = datetime.now().isoformat()
 
-    fail_count = db.execute('SELECT fail_count FROM Post WHERE weibo_id = ?', [weibo_id]).fetchone()
-    if fail_count != None:
-        db.execute('UPDATE Post SET fail_count = ? WHERE weibo_id = ?',
-                   (fail_count + 1, weibo_id))
+    entry = db.index.get(weibo_id, target)
+    if entry != None:
+        fail_count = entry[1] + 1
+        db.execute('UPDATE Post SET fail_count = ? WHERE weibo_id = ? AND target = ?',
+                   (fail_count, weibo_id, target))
     else:
-        db.execute('INSERT INTO Post VALUES (?,?,?,?,?,?,?)',
+        fail_count = 1
+        db.execute('INSERT INTO Post VALUES (?,?,?,?,?,?,?,?,?)',
                    ('', weibo_id, user_id, user_name,
-                    summary, post_time, 1))
+                    summary, post_time, fail_count, target, ''))
     db.commit()
+    db.index.put(weibo_id, (entry[0] if entry else None, fail_count),
+                 target)
+    # Make sure we look at this user’s page again next time.
+    record_page_fingerprint(user_id, None, db)
 
 
 def record_success(records, db):
     """Record successful cross postings RECORD in DB.
-RECORDS is a list of records (tuple)."""
-    ids = [[rec[1]] for rec in records]
-    db.executemany('DELETE FROM Post WHERE weibo_id = ?', ids)
-    db.executemany('INSERT INTO Post VALUES (?,?,?,?,?,?,?)', records)
+RECORDS is a list of POST_RECORD."""
+    keys = [[rec[1], rec[7]] for rec in records]
+    db.executemany('DELETE FROM Post WHERE weibo_id = ? AND target = ?', keys)
+    db.executemany('INSERT INTO Post VALUES (?,?,?,?,?,?,?,?,?)', records)
     db.commit()
+    for rec in records:
+        db.index.put(rec[1], (str(rec[0]), rec[6]), rec[7])
+
+
+def record_content_hash(post, target, db):
+    """Record the current content hash of POST on TARGET in DB."""
+    db.execute('UPDATE Post SET content_hash = ? WHERE weibo_id = ? AND target = ?',
+               (post_content_hash(post), str(post['id']), target))
+    db.commit()
+
+
+def record_deletion(weibo_id, target, db):
+    """Forget the toot of WEIBO_ID on TARGET in DB."""
+    db.execute('DELETE FROM Post WHERE weibo_id = ? AND target = ?',
+               (weibo_id, target))
+    db.commit()
+    db.index.put(weibo_id, None, target)
+
+
+def get_page_fingerprint(user_id, db):
+    """Return the fingerprint of the first page of USER_ID’s timeline
+we saw last time, or None."""
+    row = db.execute('SELECT fingerprint FROM PageFingerprint WHERE user_id = ?', [str(user_id)]).fetchone()
+    return row[0] if row else None
+
+
+def record_page_fingerprint(user_id, fingerprint, db):
+    """Record FINGERPRINT of the first page of USER_ID’s timeline in DB.
+If FINGERPRINT is None, forget the old one."""
+    if fingerprint == None:
+        db.execute('DELETE FROM PageFingerprint WHERE user_id = ?',
+                   [str(user_id)])
+    else:
+        db.execute('INSERT OR REPLACE INTO PageFingerprint VALUES (?,?)',
+                   (str(user_id), fingerprint))
+    db.commit()
+
+
+def get_missing_posts(user_id, db):
+    """Return the set of weibo ids of USER_ID that were missing from
+the first page last time we looked, see sync_posts."""
+    return {row[0] for row in db.execute(
+        'SELECT weibo_id FROM MissingPost WHERE user_id = ?',
+        [str(user_id)])}
+
+
+def record_missing_posts(user_id, weibo_ids, db):
+    """Record that WEIBO_IDS of USER_ID are missing from the first page
+in DB, forgetting the ones recorded before."""
+    db.execute('DELETE FROM MissingPost WHERE user_id = ?', [str(user_id)])
+    db.executemany('INSERT INTO MissingPost VALUES (?,?)',
+                   [(str(user_id), weibo_id) for weibo_id in weibo_ids])
+    db.commit()
+
+
+def get_user_health(user_id, db):
+    """Return the USER_HEALTH of USER_ID, or None if it is healthy."""
+    return db.execute('SELECT * FROM UserHealth WHERE user_id = ?',
+                      [str(user_id)]).fetchone()
+
+
+def record_user_failure(user_id, err, db):
+    """Record in DB that crawling USER_ID failed with ERR.
+The user is skipped for USER_BACKOFF_BASE seconds, doubled for each
+failure in a row. Return the USER_HEALTH."""
+    health = get_user_health(user_id, db)
+    fail_count = health[1] + 1 if health else 1
+    now = time.time()
+    backoff = min(USER_BACKOFF_BASE * 2 ** (fail_count - 1),
+                  USER_BACKOFF_MAX)
+    health = (str(user_id), fail_count, str(err) or type(err).__name__,
+              now, now + backoff)
+    db.execute('INSERT OR REPLACE INTO UserHealth VALUES (?,?,?,?,?)',
+               health)
+    db.commit()
+    logger.warning(u'获取%s的微博失败了%d次：%s，%d分钟后重试',
+                   user_id, fail_count, health[2], backoff // 60)
+    return health
+
+
+def record_user_success(user_id, db):
+    """Record in DB that crawling USER_ID works again."""
+    db.execute('DELETE FROM UserHealth WHERE user_id = ?', [str(user_id)])
+    db.commit()
+    logger.info(u'%s恢复正常', user_id)
+
+
+def print_user_health(db):
+    """Print the users that are failing."""
+    rows = db.execute('SELECT * FROM UserHealth ORDER BY user_id').fetchall()
+    if rows == []:
+        print(u'所有用户都正常')
+    for user_id, fail_count, last_error, failed_at, retry_at in rows:
+        print(u'{}：连续失败{}次，最近一次在{:%Y-%m-%d %H:%M}，{:%Y-%m-%d %H:%M}重试，错误：{}'.format(
+            user_id, fail_count, datetime.fromtimestamp(failed_at),
+            datetime.fromtimestamp(retry_at), last_error))
 
 
 def record_older_than(record, n):
@@ -498,8 +1445,76 @@ def record_older_than(record, n):
 
 ### Main
 
+def run_once(config, db, mast_dict):
+    """Crawl weibo and cross post new posts once, then sync edits and
+deletions of recent posts.
+Return True if everything went fine, False if crawling weibo or cross
+posting some post failed."""
+    ok = True
+    start = time.time()
+    windows = {}
+    fingerprints = {}
+    # Users with a post that didn’t make it to every target, or a
+    # deletion to confirm, their pages are looked at again next time.
+    unsettled = set()
+    try:
+        post_list = get_weibo_posts(config, db, windows, fingerprints)
+    except Exception as e:
+        post_list = []
+        ok = False
+        print("Failed to get a list of posts from weibo:")
+        print(e)
+    if db.execute('SELECT 1 FROM UserHealth WHERE failed_at >= ?',
+                  [start]).fetchone() != None:
+        ok = False
+
+    for post in post_list:
+        summary = post['text'][:30].replace('\n', ' ')
+        for target, records, err in cross_post_all(post, mast_dict,
+                                                   config, db):
+            # Mirrors are named in the log, the main account isn’t.
+            where = f'（{target["name"]}）' if target['name'] else ''
+            if err == None:
+                record_success(records, db)
+                if records != []:
+                    logger.info(u'转发了%s的微博%s：%s...',
+                                post['screen_name'], where, summary)
+            elif isinstance(err, MediaPending):
+                # Not a failure, the post is retried next time.
+                logger.info(u'%s的微博%s：%s...还在等待%s，下次再转发',
+                            post['screen_name'], where, summary, err)
+                unsettled.add(str(post['user_id']))
+            else:
+                logger.warning(u'试图转发%s的微博%s：%s...，但没有成功：%s',
+                               post['screen_name'], where, summary,
+                               str(err) or type(err).__name__)
+                record_failure(post, db, target['name'])
+                unsettled.add(str(post['user_id']))
+                ok = False
+    if not sync_posts(post_list, windows, mast_dict, config, db,
+                      unsettled):
+        ok = False
+    for user_id, fingerprint in fingerprints.items():
+        if user_id not in unsettled:
+            record_page_fingerprint(user_id, fingerprint, db)
+    return ok
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cross post weibo to Mastodon.')
+    parser.add_argument('--once', action='store_true',
+                        help='run one cycle and exit, with status 1 if anything failed')
+    parser.add_argument('--status', action='store_true',
+                        help='print the weibo users that are failing and exit')
+    args = parser.parse_args()
+
+    # weibo sets up logging for both of us.
+    import weibo
+
     db = get_db()
+    if args.status:
+        print_user_health(db)
+        exit(0)
     url = get_config(CONFIG_FILE)['mastodon_instance_url']
     mast_dict = get_mast_dict(TOKEN_FILE, url)
 
@@ -507,27 +1522,10 @@ if __name__ == '__main__':
         logger.info(u'醒了，运行中')
         # Reload configuration on-the-fly.
         config = get_config(CONFIG_FILE)
-        try:
-            post_list = get_weibo_posts(config, db)
-        except Exception as e:
-            post_list = []
-            print("Failed to get a list of posts from weibo:")
-            print(e)
-
-        for post in post_list:
-            summary = post['text'][:30].replace('\n', ' ')
-            try:
-                records = cross_post(post, mast_dict, config, db)
-                record_success(records, db)
-                if records != []:
-                    logger.info(u'转发了%s的微博：%s...',
-                                post['screen_name'], summary)
-            except MastodonError as err:
-                logger.warning(u'试图转发%s的微博：%s...，但没有成功：%s',
-                               post['screen_name'], summary, str(err))
-                record_failure(post, db)
-
+        ok = run_once(config, db, mast_dict)
         logger.info(u'完成')
+        if args.once:
+            exit(0 if ok else 1)
         sleep_time = random.randint(10, 20)
         logger.info(f'睡{sleep_time}分钟')
         time.sleep(sleep_time * 60)